@@ -9,12 +9,25 @@
 http - HTTP backend.
 """
 
+import codecs
+import collections
+import gzip
+import hashlib
 import http.client as http_client
+import io
 import json
 import logging
 import os
+import select
 import socket
 import ssl
+import stat
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from .. import errors
 from .. import http
@@ -22,6 +35,346 @@ from . import image
 
 log = logging.getLogger("backends.http")
 
+# Maximum number of in-flight zero requests. When sending many zero requests,
+# waiting for the server response after every request wastes one round trip
+# per request. Pipelining the requests and reading the responses later hides
+# the round trip time. Larger value hides more latency but delays error
+# detection and keeps more state on the server connection.
+MAX_PENDING = 32
+
+# Size of a single TLS record payload. On the TLS path every read from the
+# socket returns at most one record, so reading a large response with
+# readinto() pays one Python call per record. Reading through a buffer of
+# this size moves the per record loop into C code.
+TLS_RECORD_SIZE = 16 * 1024
+
+# Minimum size of a read-ahead request. When reading with small buffers,
+# every readinto() became one GET request, paying one round trip per buffer.
+# Reading ahead with a larger range request and serving the following reads
+# from memory amortizes the round trip over many reads. Reads of at least
+# this size bypass the read-ahead buffer, reading directly into the caller's
+# buffer.
+MIN_READAHEAD = 1024**2
+
+# Maximum size of a read-ahead request, bounding the memory held by the
+# read-ahead buffer.
+MAX_READAHEAD = 8 * 1024**2
+
+# Cached server metadata expires after this many seconds. The cache avoids
+# OPTIONS and extents requests when opening a backend for a recently used
+# URL, for example when opening new connections for a concurrent transfer.
+# The TTL must be short since the cache may become stale if another client
+# modifies the image.
+CACHE_TTL = 30
+
+# Maximum number of cached URLs. Least recently used entries are evicted
+# when the cache is full.
+CACHE_SIZE = 32
+
+# Maps (netloc, path) to dict with optional "options", "extents" and "size"
+# keys, and "expires" timestamp. Modified only via the _cache_* helpers.
+_cache = {}
+
+# The in-memory cache is also mirrored to disk, sharing server metadata with
+# other processes, for example repeated short lived client invocations for
+# the same transfer. The server does not provide validators such as etag, so
+# disk entries expire after CACHE_TTL like the in-memory entries.
+#
+# The directory is private per user; a predictable shared location would let
+# other local users poison the cached metadata. The directory ownership and
+# mode are verified before entries are trusted.
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR", "/var/tmp"),
+    "ovirt-imageio-{}".format(os.geteuid()),
+    "cache")
+
+# Version of the on-disk cache format. The cache directory is shared by all
+# client versions for a user, so entries written by another version are
+# ignored instead of being parsed with the wrong schema.
+CACHE_FORMAT = 1
+
+# Extent types for loading cached extents from disk.
+_EXTENT_TYPES = {"zero": image.ZeroExtent, "dirty": image.DirtyExtent}
+
+# Fixed shape PATCH request bodies, formatted directly instead of calling
+# json.dumps() for every request.
+ZERO_BODY = b'{"op": "zero", "offset": %d, "size": %d, "flush": %s}'
+FLUSH_BODY = b'{"op": "flush"}'
+
+JSON_HEADERS = {"content-type": "application/json"}
+
+# Idle pooled connections are dropped after this many seconds, since the
+# server may have closed its side of an idle keep-alive connection.
+POOL_IDLE_TIMEOUT = 30
+
+# Maximum number of idle connections kept per pool key.
+POOL_SIZE = 8
+
+# Maps (netloc, cafile, secure) to deque of (idle_since, connection). Closed
+# backends park their connection here, and new backends for the same server
+# reuse it, saving the TCP and TLS handshakes.
+_pool = collections.defaultdict(collections.deque)
+
+
+def _pool_get(key):
+    """
+    Return a pooled connection for key, or None if the pool is empty.
+    """
+    pool = _pool.get(key)
+    if not pool:
+        return None
+
+    now = time.monotonic()
+
+    # Take the most recently used connection; it is the least likely to
+    # have been closed by the server.
+    while pool:
+        idle_since, con = pool.pop()
+        if now - idle_since > POOL_IDLE_TIMEOUT or con.sock is None:
+            con.close()
+            continue
+        # A connection closed by the server is readable. Closing is only
+        # detectable on the reading side, so without this check the first
+        # request on the reused connection would fail.
+        readable, _, _ = select.select([con.sock], [], [], 0)
+        if readable:
+            con.close()
+            continue
+        return con
+
+    return None
+
+
+def _pool_put(key, con):
+    """
+    Park an idle connection for reuse by the next backend for key. The
+    connection is closed if the pool is full.
+    """
+    pool = _pool[key]
+    now = time.monotonic()
+
+    # Drop connections idle for too long.
+    while pool and now - pool[0][0] > POOL_IDLE_TIMEOUT:
+        pool.popleft()[1].close()
+
+    if len(pool) >= POOL_SIZE:
+        con.close()
+        return
+
+    pool.append((now, con))
+
+
+def _cache_get(key):
+    """
+    Return cached metadata dict for key, or None if the key is not cached or
+    the entry has expired. On a miss the on-disk cache is consulted, since
+    another process may have stored the metadata.
+    """
+    entry = _cache.pop(key, None)
+    if entry is not None and time.monotonic() <= entry["expires"]:
+        # Reinsert to mark the entry as most recently used.
+        _cache[key] = entry
+        return entry
+
+    entry = _cache_load(key)
+    if entry is None:
+        return None
+
+    while len(_cache) >= CACHE_SIZE:
+        del _cache[next(iter(_cache))]
+
+    _cache[key] = entry
+    return entry
+
+
+def _cache_set(key, **kwargs):
+    """
+    Update cached metadata for key, refreshing the expiration time and
+    evicting the least recently used entry if the cache is full.
+    """
+    entry = _cache.pop(key, None)
+    if entry is None or time.monotonic() > entry["expires"]:
+        entry = {}
+
+    entry.update(kwargs)
+    entry["expires"] = time.monotonic() + CACHE_TTL
+
+    while len(_cache) >= CACHE_SIZE:
+        # Dicts keep insertion order, so the first key is the least
+        # recently used one.
+        del _cache[next(iter(_cache))]
+
+    _cache[key] = entry
+    _cache_store(key, entry)
+
+
+def _cache_drop(key, *names):
+    """
+    Drop cached names for key, keeping other cached metadata. The on-disk
+    entry is always removed; it may hold the dropped names even when the
+    in-memory entry was evicted.
+    """
+    entry = _cache.get(key)
+    if entry is not None:
+        for name in names:
+            entry.pop(name, None)
+
+    try:
+        os.unlink(_cache_path(key))
+    except OSError:
+        pass
+
+
+def _cache_path(key):
+    name = hashlib.sha256("\0".join(key).encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, name + ".json.gz")
+
+
+def _check_cache_dir():
+    """
+    Verify that the cache directory is a private directory owned by the
+    current user. Raises OSError if the directory cannot be trusted, for
+    example when another user created it before us.
+    """
+    st = os.lstat(CACHE_DIR)
+    if (not stat.S_ISDIR(st.st_mode)
+            or st.st_uid != os.geteuid()
+            or st.st_mode & 0o077):
+        raise OSError(
+            "Insecure cache directory {!r}".format(CACHE_DIR))
+
+
+def _cache_load(key):
+    """
+    Return entry loaded from the on-disk cache, or None if there is no
+    usable entry. The cache is best effort; errors are ignored.
+    """
+    try:
+        _check_cache_dir()
+        with gzip.open(_cache_path(key), "rb") as f:
+            data = json.loads(f.read().decode("utf-8"))
+
+        if not isinstance(data, dict) or data.get("format") != CACHE_FORMAT:
+            return None
+
+        # Disk entries expire by wall clock time, since monotonic time is
+        # not comparable between processes.
+        remaining = data["expires"] - time.time()
+        if remaining <= 0:
+            return None
+
+        entry = {"expires": time.monotonic() + remaining}
+        for name in ("options", "size"):
+            if name in data:
+                entry[name] = data[name]
+        if "extents" in data:
+            entry["extents"] = {
+                ctx: [_EXTENT_TYPES[ctx].from_dict(d) for d in exts]
+                for ctx, exts in data["extents"].items()
+                if ctx in _EXTENT_TYPES}
+    except (OSError, EOFError, ValueError, KeyError, TypeError,
+            AttributeError):
+        # A malformed entry must not fail opening a backend, for example an
+        # entry written by a version with a buggy writer.
+        return None
+
+    return entry
+
+
+def _cache_store(key, entry):
+    """
+    Store entry in the on-disk cache. The cache is best effort; errors are
+    logged and ignored.
+    """
+    data = dict(entry)
+    data["format"] = CACHE_FORMAT
+    data["expires"] = time.time() + (entry["expires"] - time.monotonic())
+    if "extents" in data:
+        data["extents"] = {
+            ctx: [ext.to_dict() for ext in exts]
+            for ctx, exts in data["extents"].items()}
+
+    path = _cache_path(key)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        _check_cache_dir()
+        with gzip.open(tmp, "wb") as f:
+            f.write(json.dumps(data).encode("utf-8"))
+        os.replace(tmp, path)
+    except OSError as e:
+        log.debug("Cannot store cache entry for %s: %s", key, e)
+
+
+def _sendmsg(sock, buffers):
+    """
+    Send all buffers to sock using scatter/gather I/O, handling partial
+    sends.
+    """
+    buffers = [memoryview(buf) for buf in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            del buffers[0]
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def _iter_json_array(fp, bufsize=64 * 1024):
+    """
+    Iterate over items of a JSON array read from file-like object fp,
+    without reading the entire body into memory. Parsing overlaps with
+    receiving data from the server, and memory use is bounded by the size
+    of a single item instead of the entire array.
+    """
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    buf = ""
+    pos = 0
+    started = False
+
+    while True:
+        chunk = fp.read(bufsize)
+        buf = buf[pos:] + decode(chunk, final=not chunk)
+        pos = 0
+
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+
+            if pos == len(buf):
+                break
+
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError(
+                        "Expecting JSON array: {!r}".format(buf[:512]))
+                started = True
+                pos += 1
+                continue
+
+            if buf[pos] == ",":
+                pos += 1
+                continue
+
+            if buf[pos] == "]":
+                return
+
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if chunk:
+                    # The item may be incomplete, read more data.
+                    break
+                raise
+
+            yield item
+
+        if not chunk:
+            raise ValueError(
+                "Truncated JSON array: {!r}".format(buf[-512:]))
+
 
 def open(url, mode="r+", sparse=True, dirty=False, max_connections=8,
          **options):
@@ -62,6 +415,34 @@ class Backend:
         self._position = 0
         self._size = None
         self._extents = {}
+        self._cache_key = (url.netloc, url.path)
+        self._pool_key = (url.netloc, cafile, secure)
+
+        # Reused when sending range requests, avoiding dict and string
+        # allocations for every read.
+        self._range_headers = {"range": None}
+
+        # Fixed parts of the PUT and PATCH request headers, formatted once
+        # on first use. Only the varying header lines and the body are
+        # formatted per request.
+        self._put_prefix = None
+        self._patch_prefix = None
+
+        # Read-ahead buffer, keeping image data for range [_ra_start,
+        # _ra_end). Invalidated when the image is modified.
+        self._ra_buf = None
+        self._ra_start = 0
+        self._ra_end = 0
+
+        # (start, count) of a speculative read request sent without reading
+        # the response yet, or None. The response is consumed by the next
+        # sequential read, or drained before any other request.
+        self._spec_range = None
+
+        # Pipelined zero requests waiting for a response, list of (offset,
+        # length) tuples. The responses are read before sending any other
+        # request on the connection.
+        self._pending = collections.deque()
 
         # Initlized during connection.
         self._context = None
@@ -114,27 +495,66 @@ class Backend:
 
     def _connect(self):
         self._context = self._create_ssl_context()
-        self._con = self._create_tcp_connection()
-        try:
-            options = self._options()
-            log.debug("Server options: %s", options)
-            self._can_extents = options.get("extents", False)
-            self._can_zero = options.get("zero", False)
-            self._can_flush = options.get("flush", False)
-
-            # In oVirt 4.3 qemu-nbd was configured to allow only single
-            # connection, so practicaly we can have only single reader.
-            self._max_readers = options.get("max_readers", 1)
 
-            # For safety, assume that old server that does not publish
-            # max_writers does not support multiple writers.
-            self._max_writers = options.get("max_writers", 1)
+        # The server may close a pooled connection after it was parked, for
+        # example when a transfer is finalized, and the pool check cannot
+        # detect a connection closed after it. Opening on a reused
+        # connection must not fail because of stale pool state, so fall back
+        # to a fresh connection.
+        con = _pool_get(self._pool_key)
+        if con is not None:
+            log.debug("Reusing pooled connection to %r", self.url.netloc)
+            con.sock.settimeout(self._read_timeout)
+            self._con = con
+            try:
+                self._setup_connection()
+                return
+            except (errors.ProtocolError, ConnectionError,
+                    ssl.SSLEOFError) as e:
+                log.debug("Pooled connection to %r is stale, "
+                          "reconnecting: %s", self.url.netloc, e)
+                self._con.close()
+            except Exception:
+                self._con.close()
+                raise
 
-            self._optimize_connection(options.get("unix_socket"))
+        self._con = self._new_tcp_connection()
+        try:
+            self._setup_connection()
         except Exception:
             self._con.close()
             raise
 
+    def _setup_connection(self):
+        entry = _cache_get(self._cache_key)
+        if entry is not None and "options" in entry:
+            options = entry["options"]
+            log.debug("Using cached server options: %s", options)
+
+            # Reuse cached size and extents to save expensive EXTENTS
+            # calls.
+            self._size = entry.get("size")
+            for ctx, extents in entry.get("extents", {}).items():
+                self._extents[ctx] = extents.copy()
+        else:
+            options = self._speculate_open()
+            log.debug("Server options: %s", options)
+            _cache_set(self._cache_key, options=options)
+
+        self._can_extents = options.get("extents", False)
+        self._can_zero = options.get("zero", False)
+        self._can_flush = options.get("flush", False)
+
+        # In oVirt 4.3 qemu-nbd was configured to allow only single
+        # connection, so practicaly we can have only single reader.
+        self._max_readers = options.get("max_readers", 1)
+
+        # For safety, assume that old server that does not publish
+        # max_writers does not support multiple writers.
+        self._max_writers = options.get("max_writers", 1)
+
+        self._optimize_connection(options.get("unix_socket"))
+
     @property
     def name(self):
         return "http"
@@ -163,7 +583,7 @@ class Backend:
             length (int): number of bytes to read from reader
             buf (buffer): buffer to used for reading and writing.
         """
-        self._put_header(length)
+        header = self._prepare_put(length)
 
         with memoryview(buf) as view:
             max_step = len(view)
@@ -176,19 +596,56 @@ class Backend:
                         "Expected {} bytes, got {} bytes"
                         .format(length, length - todo))
                 try:
-                    self._con.send(view[:n])
+                    if header is not None:
+                        # Submit the headers with the first payload chunk,
+                        # saving one syscall per request.
+                        self._send_request(header, view[:n])
+                        header = None
+                    else:
+                        self._con.send(view[:n])
                 except (BrokenPipeError, ConnectionResetError):
                     # Server closed the connection, but it may have sent a
                     # helpful error message.
                     break
                 todo -= n
 
-        res = self._con.getresponse()
+        if header is not None:
+            # Zero length request, the headers were not sent yet.
+            self._con.sock.sendall(header)
 
-        if res.status != http_client.OK:
-            self._reraise(res.status, res.read())
+        status, body = self._read_response()
+        if status != http_client.OK:
+            self._reraise(status, body)
+
+        self._position += length
+        return length
+
+    def write_from_file(self, file, length):
+        """
+        Send PUT request with length bytes read from file current position.
+
+        When the transport supports it, the payload is sent with sendfile(),
+        moving the data directly from the page cache to the socket. On a TLS
+        connection this requires kernel TLS; otherwise the data is sent in
+        userspace.
+
+        Arguments:
+            file (file object): binary file open for reading.
+            length (int): number of bytes to send from file.
+        """
+        header = self._prepare_put(length)
+        self._con.sock.sendall(header)
+        try:
+            self._con.sock.sendfile(file, offset=file.tell(), count=length)
+        except (BrokenPipeError, ConnectionResetError):
+            # Server closed the connection, but it may have sent a helpful
+            # error message.
+            pass
+
+        status, body = self._read_response()
+        if status != http_client.OK:
+            self._reraise(status, body)
 
-        res.read()
         self._position += length
         return length
 
@@ -219,11 +676,70 @@ class Backend:
         self._position += length
         return length
 
+    def preadv(self, ranges):
+        """
+        Read multiple byte ranges, pipelining up to MAX_PENDING GET requests
+        on the connection before reading the first response. Compared with
+        one readinto() per range, this pays one round trip per batch instead
+        of one round trip per range.
+
+        The current position is not changed.
+
+        Arguments:
+            ranges: iterable of (offset, buf) pairs; every buf is filled
+                with len(buf) bytes read at offset.
+
+        Returns the total number of bytes read.
+        """
+        self._flush_pending()
+
+        if self._con.sock is None:
+            self._con.connect()
+
+        ranges = list(ranges)
+
+        total = 0
+        fp = self._con.sock.makefile("rb")
+        try:
+            # Pipeline at most MAX_PENDING requests, draining their responses
+            # before sending the next batch. Sending everything up front can
+            # deadlock when the server blocks writing responses while we
+            # block writing requests.
+            for i in range(0, len(ranges), MAX_PENDING):
+                batch = ranges[i:i + MAX_PENDING]
+                requests = []
+                for offset, buf in batch:
+                    requests.append(
+                        "GET {} HTTP/1.1\r\n"
+                        "host: {}\r\n"
+                        "range: bytes={}-{}\r\n"
+                        "\r\n".format(
+                            self.url.path, self._con.host,
+                            offset, offset + len(buf) - 1))
+
+                self._con.sock.sendall("".join(requests).encode("ascii"))
+
+                for offset, buf in batch:
+                    status, body = self._read_pipelined(fp, buf=buf)
+                    if status != http_client.PARTIAL_CONTENT:
+                        self._reraise(status, body)
+                    total += len(buf)
+        except Exception:
+            # The connection state is unknown now; closing it ensures that
+            # the next request will reconnect.
+            self._con.close()
+            raise
+        finally:
+            fp.close()
+
+        return total
+
     # Generic interface.
 
     def readinto(self, buf):
         """
-        Send GET request, reading bytes at current position into buf.
+        Read bytes at current position into buf. Reads ahead with a larger
+        GET request, serving the following contiguous reads from memory.
         """
         length = min(len(buf), self.size() - self._position)
         if length <= 0:
@@ -231,10 +747,23 @@ class Backend:
             # https://tools.ietf.org/html/rfc7233#section-2.1
             return 0
 
-        res = self._get(length)
+        if length >= MIN_READAHEAD:
+            # Large reads gain nothing from the read-ahead buffer; read
+            # directly into the caller's buffer, avoiding an extra copy.
+            res = self._get(length)
+            with memoryview(buf)[:length] as view:
+                self._read_all(res, view)
+            self._position += length
+            return length
+
+        if (self._position < self._ra_start
+                or self._position + length > self._ra_end):
+            self._read_ahead(length)
 
-        with memoryview(buf)[:length] as view:
-            self._read_all(res, view)
+        start = self._position - self._ra_start
+        with memoryview(buf)[:length] as view, \
+                memoryview(self._ra_buf) as cached:
+            view[:] = cached[start:start + length]
 
         self._position += length
         return length
@@ -244,48 +773,82 @@ class Backend:
         Send PUT request, writing buf contents at current position.
         """
         length = len(buf)
-        self._put_header(length)
+        header = self._prepare_put(length)
 
         try:
-            self._con.send(buf)
+            self._send_request(header, buf)
         except (BrokenPipeError, ConnectionResetError):
             # Server closed the connection, but it may have sent a helpful
             # error message.
             pass
 
-        res = self._con.getresponse()
-
-        if res.status != http_client.OK:
-            self._reraise(res.status, res.read())
+        status, body = self._read_response()
+        if status != http_client.OK:
+            self._reraise(status, body)
 
-        res.read()
         self._position += length
         return length
 
     def zero(self, length):
         """
         Send PATCH/zero request, writing zeroes at current position.
+
+        The request is pipelined; the server response is read before the next
+        non-zero request, when the pending queue is full, or when closing the
+        backend. Errors from pipelined requests are reported at that point.
         """
         if not self._can_zero:
             return self._emulate_zero(length)
 
-        msg = {
-            "op": "zero",
-            "offset": self._position,
-            "size": length,
-            "flush": not self._can_flush
-        }
-        self._patch(msg)
+        self._send_zero(self._position, length)
+
+        if len(self._pending) >= MAX_PENDING:
+            self._flush_pending()
 
         self._position += length
         return length
 
+    def zero_batch(self, ranges):
+        """
+        Zero multiple byte ranges, submitting up to MAX_PENDING requests
+        with a single send. Like zero(), the responses are read before the
+        next non-zero request. The current position is not changed.
+
+        Arguments:
+            ranges: iterable of (offset, length) tuples.
+        """
+        if not self._can_zero:
+            for offset, length in ranges:
+                self.seek(offset)
+                self._emulate_zero(length)
+            return
+
+        if self._con.sock is None:
+            self._con.connect()
+
+        # Zeroing invalidates cached image content metadata.
+        _cache_drop(self._cache_key, "extents", "size")
+        self._invalidate_read_ahead()
+
+        batch = []
+        for offset, length in ranges:
+            batch.append(self._format_zero(offset, length))
+            self._pending.append((offset, length))
+
+            if len(self._pending) >= MAX_PENDING:
+                self._con.sock.sendall(b"".join(batch))
+                del batch[:]
+                self._flush_pending()
+
+        if batch:
+            self._con.sock.sendall(b"".join(batch))
+
     def flush(self):
         """
         Send a PATCH/flush request, flushing changes to storage.
         """
         if self._can_flush:
-            self._patch({"op": "flush"})
+            self._patch(FLUSH_BODY)
 
     def extents(self, context="zero"):
         """
@@ -304,6 +867,10 @@ class Backend:
 
         if context not in self._extents:
             self._extents[context] = list(self._get_extents(context))
+            _cache_set(
+                self._cache_key,
+                extents={ctx: extents.copy()
+                         for ctx, extents in self._extents.items()})
 
         for ext in self._extents[context]:
             yield ext
@@ -327,17 +894,45 @@ class Backend:
         # Getting extents is more polite, so lets use it if we can.
         if self._size is None:
             if self._can_extents:
-                last = list(self.extents())[-1]
+                if "zero" in self._extents:
+                    last = self._extents["zero"][-1]
+                else:
+                    # Iterate without materializing another list; we only
+                    # need the last extent.
+                    last = None
+                    for last in self.extents():
+                        pass
                 self._size = last.start + last.length
             else:
                 self._size = self._emulate_head()
+            _cache_set(self._cache_key, size=self._size)
 
         return self._size
 
     def close(self):
+        if self._con is None:
+            return
+
         log.info("Close backend netloc=%r path=%r",
                  self.url.netloc, self.url.path)
-        self._con.close()
+        try:
+            self._flush_pending()
+        except Exception:
+            self._con.close()
+            self._con = None
+            raise
+
+        # Closing twice must not park the same connection again, sharing
+        # one socket between two future backends.
+        con = self._con
+        self._con = None
+
+        # Park healthy keep-alive connections for reuse by the next backend
+        # for this server, saving the TCP and TLS handshakes.
+        if isinstance(con, HTTPSConnection) and con.sock is not None:
+            _pool_put(self._pool_key, con)
+        else:
+            con.close()
 
     def __enter__(self):
         return self
@@ -367,9 +962,25 @@ class Backend:
             context.check_hostname = False
             context.verify_mode = ssl.CERT_NONE
 
+        # With kernel TLS the kernel encrypts the data, so sendfile() can
+        # move data directly from the page cache to the TLS socket. Needs
+        # python 3.12, OpenSSL 3.0 and the tls kernel module; ignored
+        # otherwise.
+        if hasattr(ssl, "OP_ENABLE_KTLS"):
+            context.options |= ssl.OP_ENABLE_KTLS
+
         return context
 
     def _create_tcp_connection(self):
+        con = _pool_get(self._pool_key)
+        if con is not None:
+            log.debug("Reusing pooled connection to %r", self.url.netloc)
+            con.sock.settimeout(self._read_timeout)
+            return con
+
+        return self._new_tcp_connection()
+
+    def _new_tcp_connection(self):
         log.debug("Connecting to tcp socket %r", self.url.netloc)
         con = HTTPSConnection(
             self.url.netloc,
@@ -420,11 +1031,12 @@ class Backend:
             return self._create_unix_connection(self.server_address)
 
     def _get(self, length):
-        headers = {}
-        headers["range"] = "bytes={}-{}".format(
+        self._flush_pending()
+
+        self._range_headers["range"] = b"bytes=%d-%d" % (
             self._position, self._position + length - 1)
 
-        self._con.request("GET", self.url.path, headers=headers)
+        self._con.request("GET", self.url.path, headers=self._range_headers)
         res = self._con.getresponse()
 
         if res.status != http_client.PARTIAL_CONTENT:
@@ -438,25 +1050,181 @@ class Backend:
 
         return res
 
-    def _put_header(self, length):
-        path = self.url.path
-        if self._can_flush:
-            path += "?flush=n"
+    def _read_ahead(self, length):
+        """
+        Fill the read-ahead buffer with data for current position. Reads at
+        least length bytes, more if the remaining image data is larger than
+        the minimum read-ahead size. After filling the buffer, the next
+        window is requested speculatively, hiding its round trip behind the
+        caller's processing of the current window.
+        """
+        if not self._read_speculated(length):
+            count = min(
+                max(MIN_READAHEAD, length * 8),
+                MAX_READAHEAD,
+                self.size() - self._position)
+
+            res = self._get(count)
+
+            if self._ra_buf is None or len(self._ra_buf) < count:
+                self._ra_buf = bytearray(count)
+
+            with memoryview(self._ra_buf)[:count] as view:
+                self._read_all(res, view)
+
+            self._ra_start = self._position
+            self._ra_end = self._position + count
+
+        self._speculate_read(length)
+
+    def _read_speculated(self, length):
+        """
+        Try to fill the read-ahead buffer from the response of a previously
+        speculated read, returning True on success. A speculation that does
+        not match the current position is drained and discarded.
+        """
+        if self._spec_range is None:
+            return False
+
+        start, count = self._spec_range
+        if start != self._position or count < length:
+            self._drain_speculation()
+            return False
+
+        self._spec_range = None
+
+        if self._ra_buf is None or len(self._ra_buf) < count:
+            self._ra_buf = bytearray(count)
+
+        fp = self._con.sock.makefile("rb")
+        try:
+            with memoryview(self._ra_buf)[:count] as view:
+                status, body = self._read_pipelined(fp, buf=view)
+        except Exception:
+            # The connection state is unknown now; closing it ensures that
+            # the next request will reconnect.
+            self._con.close()
+            raise
+        finally:
+            fp.close()
+
+        if status != http_client.PARTIAL_CONTENT:
+            self._reraise(status, body)
+
+        self._ra_start = start
+        self._ra_end = start + count
+        return True
+
+    def _speculate_read(self, length):
+        """
+        Request the next read-ahead window without reading the response.
+        For sequential reads the response is already in the socket buffer
+        when the current window is exhausted.
+        """
+        if self._spec_range is not None or self._pending:
+            return
+
+        if self._con.sock is None:
+            return
+
+        start = self._ra_end
+        count = min(
+            max(MIN_READAHEAD, length * 8),
+            MAX_READAHEAD,
+            self.size() - start)
+        if count <= 0:
+            return
 
-        self._con.putrequest("PUT", path)
+        request = ("GET {} HTTP/1.1\r\n"
+                   "host: {}\r\n"
+                   "range: bytes={}-{}\r\n"
+                   "\r\n").format(
+                       self.url.path, self._con.host,
+                       start, start + count - 1)
+        self._con.sock.sendall(request.encode("ascii"))
+        self._spec_range = (start, count)
+
+    def _drain_speculation(self):
+        """
+        Read and discard the response of a speculative read that will not
+        be consumed.
+        """
+        if self._spec_range is None:
+            return
+
+        self._spec_range = None
+        if self._con.sock is None:
+            return
+
+        fp = self._con.sock.makefile("rb")
+        try:
+            self._read_pipelined(fp)
+        except Exception as e:
+            log.debug("Discarding speculative read response: %s", e)
+            self._con.close()
+        finally:
+            fp.close()
+
+    def _invalidate_read_ahead(self):
+        self._ra_start = self._ra_end = 0
+
+        # The speculated response was generated before the change, so it
+        # must not be consumed.
+        self._drain_speculation()
+
+    def _prepare_put(self, length):
+        """
+        Prepare sending a PUT request, returning the request header bytes.
+        The caller must send the header and length bytes of payload on the
+        connection socket, and read the server response with
+        _read_response().
+        """
+        self._flush_pending()
+
+        # Writing invalidates cached image content metadata.
+        _cache_drop(self._cache_key, "extents", "size")
+        self._invalidate_read_ahead()
+
+        if self._con.sock is None:
+            self._con.connect()
+
+        if self._put_prefix is None:
+            path = self.url.path
+            if self._can_flush:
+                path += "?flush=n"
+            self._put_prefix = (
+                "PUT {} HTTP/1.1\r\n"
+                "host: {}\r\n"
+                "content-type: application/octet-stream\r\n").format(
+                    path, self._con.host).encode("ascii")
+
+        return self._put_prefix + (
+            b"content-length: %d\r\n"
+            b"content-range: bytes %d-%d/*\r\n"
+            b"\r\n" % (length,
+                       self._position,
+                       self._position + length - 1))
 
-        self._con.putheader("content-length", length)
-        self._con.putheader("content-type", "application/octet-stream")
-        self._con.putheader("content-range", "bytes {}-{}/*".format(
-                self._position, self._position + length - 1))
+    def _put_header(self, length):
+        self._con.sock.sendall(self._prepare_put(length))
 
-        self._con.endheaders()
+    def _send_request(self, header, payload):
+        """
+        Send request header and payload. On unix socket connections both are
+        sent in a single scatter/gather syscall, without copying the payload.
+        """
+        if isinstance(self._con, UnixHTTPConnection):
+            with memoryview(payload) as view:
+                _sendmsg(self._con.sock, [header, view])
+        else:
+            self._con.sock.sendall(header)
+            self._con.sock.sendall(payload)
 
-    def _patch(self, msg):
-        body = json.dumps(msg).encode("utf-8")
-        headers = {"content-type": "application/json"}
+    def _patch(self, body):
+        self._flush_pending()
 
-        self._con.request("PATCH", self.url.path, body=body, headers=headers)
+        self._con.request(
+            "PATCH", self.url.path, body=body, headers=JSON_HEADERS)
         res = self._con.getresponse()
 
         if res.status != http_client.OK:
@@ -464,22 +1232,70 @@ class Backend:
 
         res.read()
 
-    def _options(self):
-        self._con.request("OPTIONS", self.url.path)
-        res = self._con.getresponse()
-        body = res.read()
+    def _speculate_open(self):
+        """
+        Send OPTIONS pipelined with a speculative GET for zero extents,
+        hiding the extents round trip behind the OPTIONS round trip.
+
+        The speculative request includes a one byte range, so an old server
+        treating the extents path as an image read returns at most one byte;
+        a server supporting extents ignores the range and returns the
+        complete extents list.
+        """
+        requests = ("OPTIONS {0} HTTP/1.1\r\n"
+                    "host: {1}\r\n"
+                    "\r\n"
+                    "GET {0}/extents?context=zero HTTP/1.1\r\n"
+                    "host: {1}\r\n"
+                    "range: bytes=0-0\r\n"
+                    "\r\n").format(self.url.path, self._con.host)
+
+        self._con.sock.sendall(requests.encode("ascii"))
+
+        fp = self._con.sock.makefile("rb")
+        try:
+            status, body = self._read_pipelined(fp)
+            options = self._parse_options(status, body)
+
+            status = None
+            if self._con.sock is not None:
+                try:
+                    status, body = self._read_pipelined(fp)
+                except Exception as e:
+                    # The server closed the connection after the first
+                    # response; it will reconnect on the next request.
+                    log.debug("Discarding speculative extents response: %s",
+                              e)
+                    self._con.close()
+        finally:
+            fp.close()
+
+        if status == http_client.OK and options.get("extents", False):
+            extents = [image.ZeroExtent.from_dict(ext)
+                       for ext in json.loads(body.decode("utf-8"))]
+            if extents:
+                self._extents["zero"] = extents
+                last = extents[-1]
+                self._size = last.start + last.length
+                _cache_set(
+                    self._cache_key,
+                    extents={"zero": extents.copy()},
+                    size=self._size)
+
+        return options
 
+    def _parse_options(self, status, body):
         options = {}
 
-        if res.status == http_client.METHOD_NOT_ALLOWED:
+        if status == http_client.METHOD_NOT_ALLOWED:
             # Older daemon did not implement OPTIONS
             return options
-        elif res.status == http_client.NO_CONTENT:
+        elif status == http_client.NO_CONTENT:
             # Older proxy did implement OPTIONS but does not return any
             # content.
             return options
-        elif res.status != http_client.OK:
-            raise self._reraise(res.status, body)
+        elif status != http_client.OK:
+            raise self._reraise(status, body)
 
         # New daemon or proxy provides options dict.
         try:
@@ -497,24 +1313,156 @@ class Backend:
 
         return options
 
+    def _send_zero(self, offset, size):
+        """
+        Send PATCH/zero request without reading the response. The response is
+        read later in _flush_pending(), allowing multiple in-flight requests.
+
+        http.client supports only one in-flight request, so we send the
+        request bytes directly on the socket. The connection state machine is
+        not affected since all responses are consumed before it is used again.
+        """
+        if self._con.sock is None:
+            self._con.connect()
+
+        # Zeroing invalidates cached image content metadata.
+        _cache_drop(self._cache_key, "extents", "size")
+        self._invalidate_read_ahead()
+
+        self._con.sock.sendall(self._format_zero(offset, size))
+        self._pending.append((offset, size))
+
+    def _format_zero(self, offset, size):
+        # When the server cannot flush we must flush every request.
+        body = ZERO_BODY % (
+            offset, size, b"false" if self._can_flush else b"true")
+
+        if self._patch_prefix is None:
+            self._patch_prefix = (
+                "PATCH {} HTTP/1.1\r\n"
+                "host: {}\r\n"
+                "content-type: application/json\r\n").format(
+                    self.url.path, self._con.host).encode("ascii")
+
+        return (self._patch_prefix
+                + (b"content-length: %d\r\n\r\n" % len(body))
+                + body)
+
+    def _flush_pending(self):
+        """
+        Read responses for all pipelined zero requests, raising if the server
+        reported an error for any of them.
+        """
+        # A speculative read was sent before any pending zero request, so
+        # its response must be drained first.
+        self._drain_speculation()
+
+        if not self._pending:
+            return
+
+        # All pending responses must be parsed from a single buffered reader;
+        # a reader per response may buffer data belonging to the next
+        # response and lose it when discarded.
+        fp = self._con.sock.makefile("rb")
+        try:
+            while self._pending:
+                offset, size = self._pending.popleft()
+                status, body = self._read_pipelined(fp)
+                if status != http_client.OK:
+                    log.debug("Pipelined zero failed offset=%s size=%s",
+                              offset, size)
+                    self._reraise(status, body)
+        except Exception:
+            # The connection state is unknown now; closing it ensures that
+            # the next request will reconnect.
+            self._pending.clear()
+            self._con.close()
+            raise
+        finally:
+            fp.close()
+
+    def _read_pipelined(self, fp, buf=None):
+        """
+        Read one HTTP response from buffered reader fp, returning (status,
+        body) tuple. If buf is set and the response is successful, the body
+        is read into buf and the returned body is empty.
+        """
+        status_line = fp.readline(4096)
+        fields = status_line.split(None, 2)
+        if len(fields) < 2:
+            raise errors.ProtocolError(
+                "Invalid status line {!r}, server closed the connection?"
+                .format(status_line))
+
+        status = int(fields[1])
+        headers = http_client.parse_headers(fp)
+        length = int(headers.get("content-length", 0))
+
+        if buf is not None and status == http_client.PARTIAL_CONTENT:
+            if length != len(buf):
+                raise errors.ProtocolError(
+                    "Unexpected content-length={} expected={}"
+                    .format(length, len(buf)))
+            n = fp.readinto(buf)
+            if n < length:
+                raise errors.ProtocolError(
+                    "Expected {} bytes, got {} bytes".format(length, n))
+            body = b""
+        else:
+            body = fp.read(length) if length else b""
+
+        if headers.get("connection", "").lower() == "close":
+            # The server will not serve more requests on this connection;
+            # closing it ensures that the next request will reconnect.
+            self._con.close()
+
+        return status, body
+
+    def _read_response(self):
+        """
+        Read a response for a request sent directly on the connection
+        socket, bypassing the http.client request state machine.
+        """
+        fp = self._con.sock.makefile("rb")
+        try:
+            return self._read_pipelined(fp)
+        finally:
+            fp.close()
+
     def _get_extents(self, context):
+        self._flush_pending()
+
         self._con.request("GET", self.url.path + "/extents?context=" + context)
         res = self._con.getresponse()
-        data = res.read()
 
         if res.status == http_client.NOT_FOUND:
             raise errors.UnsupportedOperation(
                 "Server does not support {} extents: {}"
-                .format(context, data[:512]))
+                .format(context, res.read()[:512]))
 
         if res.status != http_client.OK:
-            self._reraise(res.status, data)
-
-        extents = json.loads(data.decode("utf-8"))
+            self._reraise(res.status, res.read())
 
         cls = image.ZeroExtent if context == "zero" else image.DirtyExtent
-        for ext in extents:
-            yield cls.from_dict(ext)
+
+        length = int(res.getheader("content-length") or 0)
+        if orjson is not None and length > 0:
+            # Read the body into a preallocated buffer and parse with
+            # orjson, which is several times faster than the stdlib parser
+            # for large arrays.
+            buf = bytearray(length)
+            self._read_all(res, buf)
+            for ext in orjson.loads(buf):
+                yield cls.from_dict(ext)
+        else:
+            # Parse the response incrementally; extents metadata can be
+            # large, and this avoids holding the entire JSON body in
+            # memory.
+            for ext in _iter_json_array(res):
+                yield cls.from_dict(ext)
+
+            # Consume trailing data so the connection can be reused.
+            res.read()
 
     def _emulate_head(self):
         """
@@ -524,6 +1472,8 @@ class Backend:
 
         NOTE: Logs noisy tracebacks in the daemon logs.
         """
+        self._flush_pending()
+
         self._con.request("GET", self.url.path)
         res = self._con.getresponse()
 
@@ -550,25 +1500,26 @@ class Backend:
             todo -= len(buf)
         self._con.send(memoryview(buf)[:todo])
 
-        res = self._con.getresponse()
+        status, body = self._read_response()
+        if status != http_client.OK:
+            self._reraise(status, body)
 
-        if res.status != http_client.OK:
-            self._reraise(res.status, res.read())
-
-        res.read()
         self._position += length
         return length
 
     def _read_all(self, res, buf):
-        with memoryview(buf) as view:
-            length = len(view)
-            pos = 0
-            while pos < length:
-                n = res.readinto(view[pos:])
-                if n == 0:
-                    raise RuntimeError(
-                        "Expected {} byes, got {} bytes".format(length, pos))
-                pos += n
+        # The buffered reader loops over the per TLS record reads in C
+        # code, leaving one Python call per response. It reads into buf
+        # directly, so no intermediate memoryview is needed.
+        reader = io.BufferedReader(res, buffer_size=TLS_RECORD_SIZE)
+        try:
+            pos = reader.readinto(buf)
+            if pos < len(buf):
+                raise RuntimeError(
+                    "Expected {} byes, got {} bytes".format(len(buf), pos))
+        finally:
+            # Detach so closing the reader does not close the response.
+            reader.detach()
 
     def _reraise(self, status, body):
         """
@@ -590,6 +1541,34 @@ class HTTPSConnection(http_client.HTTPSConnection):
     Enhanced HTTPS connection.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tls_session = None
+
+    def connect(self):
+        """
+        Override to tune the socket for small latency sensitive requests,
+        and to resume the previous TLS session when reconnecting, cutting
+        the handshake from 2 round trips to 1.
+        """
+        sock = socket.create_connection(
+            (self.host, self.port), self.timeout, self.source_address)
+
+        # Disable Nagle's algorithm and delayed ACKs; zero and flush
+        # requests are tiny and waiting for more data to send only adds
+        # latency.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_QUICKACK"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+        self.sock = self._context.wrap_socket(
+            sock, server_hostname=self.host, session=self._tls_session)
+
+        # Keep the session for an abbreviated handshake on the next
+        # connect.
+        self._tls_session = self.sock.session
+
     def is_local(self):
         """
         Return True if connected to the local host.
@@ -7,6 +7,7 @@
 # (at your option) any later version.
 
 import logging
+import mmap
 import os
 
 from .. import errors
@@ -14,6 +15,10 @@ from . import image
 
 log = logging.getLogger("backends.memory")
 
+# Shared zero buffer, written in chunks when zeroing. Keeps memory use
+# bounded regardless of the zeroed length.
+ZERO_BUF = bytes(1024**2)
+
 
 def open(url, mode="r", sparse=False, dirty=False, max_connections=8,
          **options):
@@ -142,7 +147,17 @@ class Backend:
         self._check_closed()
         if not self.writable():
             raise IOError("Unsupproted operation: zero")
-        return self.write(b"\0" * count)
+
+        # Write the shared zero buffer in chunks instead of allocating a
+        # count bytes buffer, which may be huge.
+        todo = count
+        with memoryview(ZERO_BUF) as view:
+            while todo > len(view):
+                self.write(view)
+                todo -= len(view)
+            self.write(view[:todo])
+
+        return count
 
     @property
     def block_size(self):
@@ -201,6 +216,69 @@ class Backend:
             raise ValueError("Operation on closed backend")
 
 
+class FDBackend(Backend):
+    """
+    Memory backend backed by an anonymous file, for testing zero copy
+    paths such as sendfile() that require a real file descriptor.
+
+    Unlike Backend, the image size is fixed at creation time, since an
+    mmapped buffer cannot grow.
+    """
+
+    def __init__(self, mode="r", size=None, max_connections=8, extents=None,
+                 fd=None):
+        if fd is None:
+            fd = os.memfd_create("ovirt-imageio")
+            try:
+                os.ftruncate(fd, size)
+            except BaseException:
+                os.close(fd)
+                raise
+        else:
+            # Keep a private descriptor so every backend can be closed
+            # independently.
+            fd = os.dup(fd)
+
+        try:
+            buf = mmap.mmap(fd, 0)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        super().__init__(
+            mode=mode,
+            data=buf,
+            max_connections=max_connections,
+            extents=extents)
+        self._fd = fd
+
+    def clone(self):
+        """
+        Return a new backend sharing the same backing file.
+        """
+        return self.__class__(
+            mode=self._mode,
+            max_connections=self._max_connections,
+            extents=self._extents,
+            fd=self._fd)
+
+    def fileno(self):
+        self._check_closed()
+        return self._fd
+
+    def write(self, buf):
+        self._check_closed()
+        if self._position + len(buf) > self.size():
+            raise IOError("Write after end of file")
+        return super().write(buf)
+
+    def close(self):
+        if not self._closed:
+            self._buf.close()
+            os.close(self._fd)
+        super().close()
+
+
 class ReaderFrom(Backend):
 
     def read_from(self, reader, length, buf):
@@ -57,6 +57,13 @@ class TicketCancelTimeout(Error):
         self.ticket_id = ticket_id
 
 
+class ProtocolError(Error):
+    msg = "Invalid response from server: {self.reason}"
+
+    def __init__(self, reason):
+        self.reason = reason
+
+
 class UnsupportedOperation(Error):
     msg = "Operation not supported: {self.reason}"
 
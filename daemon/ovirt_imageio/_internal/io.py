@@ -30,6 +30,10 @@ MAX_BUFFER_SIZE = 32 * 1024**2
 BUFFER_SIZE = 4 * 1024**2
 MAX_WORKERS = 4
 
+# Maximum number of zero requests submitted to the backend in one batch,
+# when the destination backend supports batching.
+ZERO_BATCH_SIZE = 32
+
 log = logging.getLogger("io")
 
 
@@ -265,14 +269,27 @@ class Handler:
         self._buf = bytearray(buffer_size)
         self._progress = progress
 
+        # Zero requests accumulated for batch submission.
+        self._zeros = []
+
     def zero(self, req):
         # TODO: Assumes complete zero(); not compatible with file backend.
-        self._dst.seek(req.start)
-        self._dst.zero(req.length)
+        if hasattr(self._dst, "zero_batch"):
+            # Accumulate zero requests, submitting them in one batch when
+            # the batch is full or before the next copy or flush.
+            self._zeros.append((req.start, req.length))
+            if len(self._zeros) >= ZERO_BATCH_SIZE:
+                self._flush_zeros()
+        else:
+            self._dst.seek(req.start)
+            self._dst.zero(req.length)
+
         if self._progress:
             self._progress.update(req.length)
 
     def copy(self, req):
+        self._flush_zeros()
+
         self._src.seek(req.start)
         self._dst.seek(req.start)
 
@@ -287,8 +304,14 @@ class Handler:
             self._progress.update(req.length)
 
     def flush(self, req):
+        self._flush_zeros()
         self._dst.flush()
 
+    def _flush_zeros(self):
+        if self._zeros:
+            self._dst.zero_batch(self._zeros)
+            del self._zeros[:]
+
     def close(self):
         # Error while closing the destination backend should fail the
         # operation. Error in closing source is not fatal, but we want to know
@@ -6,9 +6,12 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import gzip
 import io
 import json
 import logging
+import os
+import socket
 
 import pytest
 
@@ -20,12 +23,27 @@ from ovirt_imageio._internal import uhttp
 from ovirt_imageio._internal import util
 from ovirt_imageio._internal import errors
 
+from ovirt_imageio._internal.backends import http as http_backend
 from ovirt_imageio._internal.backends import image
 from ovirt_imageio._internal.backends.http import Backend
 
 log = logging.getLogger("test")
 
 
+@pytest.fixture(autouse=True)
+def fresh_state(tmpdir, monkeypatch):
+    # Every test replaces the server personality, so server metadata and
+    # pooled connections from a previous test must not leak into the next
+    # one. The on-disk cache is kept private to each test.
+    monkeypatch.setattr(
+        http_backend, "CACHE_DIR", str(tmpdir.join("cache")))
+    http_backend._cache.clear()
+    for pool in http_backend._pool.values():
+        while pool:
+            pool.popleft()[1].close()
+    http_backend._pool.clear()
+
+
 @pytest.fixture(scope="module")
 def http_server(tmp_pki):
     server = http.Server(("localhost", 0), http.Connection)
@@ -197,7 +215,9 @@ class Daemon(Handler):
         """
         Override to dispatch "GET /extents" resource.
         """
-        if path == "/extents":
+        # Python 3.11 http.server collapses the leading "//" in the request
+        # target, so we may get "extents" instead of "/extents".
+        if path.lstrip("/") == "extents":
             self.requests += 1
             context = req.query.get("context", "zero")
             self._extents(resp, context)
@@ -311,6 +331,13 @@ def test_old_daemon_read_from(http_server):
         assert not handler.dirty
 
 
+def test_old_daemon_write_from_file(tmpdir, http_server):
+    # Over TLS without kernel TLS sendfile falls back to userspace send.
+    handler = OldDaemon(http_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        check_write_from_file(handler, b, tmpdir)
+
+
 def test_old_daemon_write_to(http_server):
     handler = OldDaemon(http_server)
     with Backend(http_server.url, http_server.cafile) as b:
@@ -335,6 +362,78 @@ def test_old_daemon_size_error(http_server):
     assert e.value.code == http.FORBIDDEN
 
 
+def test_old_daemon_connection_pool(http_server):
+    OldDaemon(http_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        con = b._con
+
+    # Closing parked the connection in the pool, so the next backend for
+    # this server reuses it instead of reconnecting.
+    with Backend(http_server.url, http_server.cafile) as b:
+        assert b._con is con
+
+
+def test_old_daemon_pool_server_closed(http_server):
+    handler = OldDaemon(http_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        con = b._con
+
+    # Simulate the server closing the parked connection. A closed socket is
+    # readable, so the pool must drop it instead of handing it out.
+    con.sock.shutdown(socket.SHUT_RDWR)
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        assert b._con is not con
+        assert b.size() == len(handler.image)
+
+
+def test_old_daemon_pool_stale_connection(http_server, monkeypatch):
+    handler = OldDaemon(http_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        con = b._con
+
+    # Simulate the server closing the connection after the pool check
+    # passed; only the first request on the connection can detect this.
+    con.sock.shutdown(socket.SHUT_RDWR)
+
+    def pool_get_unchecked(key):
+        pool = http_backend._pool.get(key)
+        return pool.pop()[1] if pool else None
+
+    monkeypatch.setattr(http_backend, "_pool_get", pool_get_unchecked)
+
+    # Drop cached metadata so opening must talk to the server.
+    http_backend._cache.clear()
+    http_backend._cache_drop((http_server.url.netloc, http_server.url.path))
+
+    # Opening must fall back to a fresh connection.
+    with Backend(http_server.url, http_server.cafile) as b:
+        assert b._con is not con
+        assert b.size() == len(handler.image)
+
+
+def test_old_daemon_close_twice(http_server):
+    OldDaemon(http_server)
+    b = Backend(http_server.url, http_server.cafile)
+    con = b._con
+    b.close()
+
+    # Closing again must not park the same connection twice, sharing one
+    # socket between two future backends.
+    b.close()
+
+    pool = http_backend._pool[b._pool_key]
+    assert [c for _, c in pool] == [con]
+
+
+def test_old_daemon_socket_options(http_server):
+    OldDaemon(http_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        sock = b._con.sock
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+
+
 # Old proxy tests
 
 def test_old_proxy_open(http_server):
@@ -483,6 +582,90 @@ def test_daemon_open(http_server, uhttp_server):
         ]
 
 
+def test_daemon_disk_cache(http_server, uhttp_server):
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        size = b.size()
+        extents = list(b.extents())
+
+    # Simulate a new process by dropping the in-memory cache. The metadata
+    # is served from the on-disk cache without any request.
+    http_backend._cache.clear()
+    handler.requests = 0
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        assert b.size() == size
+        assert list(b.extents()) == extents
+
+    assert handler.requests == 0
+
+
+def gzip_json(obj):
+    return gzip.compress(json.dumps(obj).encode("utf-8"))
+
+
+@pytest.mark.parametrize("data", [
+    pytest.param(b"not a cache entry", id="not-gzip"),
+    pytest.param(gzip_json("not a dict"), id="not-dict"),
+    pytest.param(
+        gzip_json({"expires": 10**10, "size": 512}),
+        id="no-format"),
+    pytest.param(
+        gzip_json({
+            "format": http_backend.CACHE_FORMAT,
+            "expires": "never",
+            "size": 512,
+        }),
+        id="bad-expires"),
+    pytest.param(
+        gzip_json({
+            "format": http_backend.CACHE_FORMAT,
+            "expires": 10**10,
+            "extents": ["not a dict"],
+        }),
+        id="bad-extents"),
+    pytest.param(
+        gzip_json({
+            "format": http_backend.CACHE_FORMAT,
+            "expires": 10**10,
+            "extents": {"zero": ["not a dict"]},
+        }),
+        id="bad-extent-item"),
+])
+def test_daemon_disk_cache_invalid(http_server, uhttp_server, data):
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        b.size()
+
+    # Corrupted or malformed cache entries are ignored.
+    key = (http_server.url.netloc, http_server.url.path)
+    with open(http_backend._cache_path(key), "wb") as f:
+        f.write(data)
+
+    http_backend._cache.clear()
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        assert b.size() == len(handler.image)
+
+
+def test_daemon_disk_cache_insecure(http_server, uhttp_server):
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        b.size()
+
+    # Entries in a cache directory accessible to other users are not
+    # trusted, since they could have been planted.
+    os.chmod(http_backend.CACHE_DIR, 0o755)
+
+    http_backend._cache.clear()
+    handler.requests = 0
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        assert b.size() == len(handler.image)
+
+    assert handler.requests > 0
+
+
 def test_daemon_open_insecure(http_server, uhttp_server):
     Daemon(http_server, uhttp_server)
     with Backend(http_server.url, None, secure=False) as b:
@@ -588,6 +771,120 @@ def test_daemon_readinto(http_server, uhttp_server):
         check_readinto(handler, b)
 
 
+def test_daemon_readinto_read_ahead(http_server, uhttp_server):
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        chunk_size = 64 * 1024
+        buf = bytearray(chunk_size)
+
+        # Getting size may fetch extents from the server.
+        b.size()
+        handler.requests = 0
+
+        # Sequential small reads are served by a single larger request.
+        for offset in range(0, len(handler.image), chunk_size):
+            b.readinto(buf)
+            assert buf == handler.image[offset:offset + chunk_size]
+
+        assert handler.requests == 1
+        assert b.tell() == len(handler.image)
+
+        # Writing invalidates the read-ahead buffer, so the next read gets
+        # fresh data from the server.
+        b.seek(0)
+        b.write(b"x" * chunk_size)
+        b.seek(0)
+        b.readinto(buf)
+        assert buf == b"x" * chunk_size
+
+
+def test_daemon_readinto_speculation(monkeypatch, http_server, uhttp_server):
+    # Lower the read-ahead size so a sequential scan needs several windows.
+    monkeypatch.setattr(http_backend, "MIN_READAHEAD", 64 * 1024)
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        chunk_size = 8 * 1024
+        buf = bytearray(chunk_size)
+        b.size()
+
+        # Sequential reads are served from speculated responses.
+        for offset in range(0, 4 * 64 * 1024, chunk_size):
+            b.readinto(buf)
+            assert buf == handler.image[offset:offset + chunk_size]
+
+        # Seeking away discards the speculated response.
+        b.seek(512 * 1024)
+        b.readinto(buf)
+        assert buf == handler.image[512 * 1024:512 * 1024 + chunk_size]
+
+        # Writing discards the speculated response, so the next read gets
+        # fresh data.
+        b.seek(0)
+        b.write(b"x" * chunk_size)
+        b.seek(0)
+        b.readinto(buf)
+        assert buf == b"x" * chunk_size
+
+
+def test_daemon_readinto_large(monkeypatch, http_server, uhttp_server):
+    monkeypatch.setattr(http_backend, "MIN_READAHEAD", 64 * 1024)
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        # Reads of at least MIN_READAHEAD bypass the read-ahead buffer,
+        # reading directly into the caller's buffer.
+        chunk_size = 128 * 1024
+        buf = bytearray(chunk_size)
+        for offset in range(0, 4 * chunk_size, chunk_size):
+            b.readinto(buf)
+            assert buf == handler.image[offset:offset + chunk_size]
+        assert b._ra_buf is None
+
+
+def test_daemon_preadv(http_server, uhttp_server):
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        chunk_size = 64 * 1024
+        ranges = [(i * chunk_size, bytearray(chunk_size))
+                  for i in range(0, 8, 2)]
+
+        n = b.preadv(ranges)
+
+        assert n == sum(len(buf) for _, buf in ranges)
+        for offset, buf in ranges:
+            assert buf == handler.image[offset:offset + len(buf)]
+
+
+def test_daemon_preadv_many(http_server, uhttp_server):
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        # More ranges than MAX_PENDING, read in multiple batches.
+        chunk_size = 4096
+        count = http_backend.MAX_PENDING * 2 + 1
+        ranges = [(i * chunk_size, bytearray(chunk_size))
+                  for i in range(count)]
+
+        n = b.preadv(ranges)
+
+        assert n == sum(len(buf) for _, buf in ranges)
+        for offset, buf in ranges:
+            assert buf == handler.image[offset:offset + len(buf)]
+
+
+def test_daemon_preadv_error(http_server, uhttp_server):
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+
+        def fail(req, resp, tid):
+            raise http.Error(http.FORBIDDEN, "Fake error")
+
+        handler.get = fail
+
+        with pytest.raises(http.Error) as e:
+            b.preadv([(0, bytearray(4096))])
+
+        assert e.value.code == http.FORBIDDEN
+
+
 def test_daemon_readinto_error(http_server, uhttp_server):
     handler = Daemon(http_server, uhttp_server)
     with Backend(http_server.url, http_server.cafile) as b:
@@ -638,6 +935,16 @@ def test_daemon_write_error(http_server, uhttp_server):
         check_write_error(handler, b)
 
 
+def test_daemon_write_from_file(tmpdir, http_server, uhttp_server):
+    # Over the unix socket the payload is sent with real sendfile().
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        check_write_from_file(handler, b, tmpdir)
+        assert handler.dirty
+        b.flush()
+        assert not handler.dirty
+
+
 def test_daemon_zero(http_server, uhttp_server):
     handler = Daemon(http_server, uhttp_server)
     with Backend(http_server.url, http_server.cafile) as b:
@@ -647,6 +954,27 @@ def test_daemon_zero(http_server, uhttp_server):
         assert not handler.dirty
 
 
+def test_daemon_zero_batch(http_server, uhttp_server):
+    handler = Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile) as b:
+        chunk_size = 64 * 1024
+        # Fill the image with non-zero data so zeroed ranges can be told
+        # apart from preserved ones.
+        handler.image[:] = b"x" * len(handler.image)
+        ranges = [(i * chunk_size, chunk_size) for i in range(0, 16, 2)]
+
+        b.zero_batch(ranges)
+        b.flush()
+
+        for offset, length in ranges:
+            assert (handler.image[offset:offset + length] ==
+                    b"\0" * length)
+
+        # Ranges not in the batch are not zeroed.
+        assert (handler.image[chunk_size:2 * chunk_size] ==
+                b"x" * chunk_size)
+
+
 def test_daemon_zero_error(http_server, uhttp_server):
     handler = Daemon(http_server, uhttp_server)
     with Backend(http_server.url, http_server.cafile) as b:
@@ -735,6 +1063,35 @@ def test_clone_unix(http_server, uhttp_server):
             assert buf == b"x" * 4096
 
 
+# Streaming JSON parser tests
+
+@pytest.mark.parametrize("data,items", [
+    (b"[]", []),
+    (b" [ ] ", []),
+    (b"[1, 2, 3]", [1, 2, 3]),
+    (b'[{"start": 0, "length": 100}]', [{"start": 0, "length": 100}]),
+    (b'[{"a": 1},\n {"a": 2}]\n', [{"a": 1}, {"a": 2}]),
+])
+def test_iter_json_array(data, items):
+    # Use bufsize=1 to exercise parsing items split over multiple reads.
+    assert list(http_backend._iter_json_array(io.BytesIO(data))) == items
+    assert list(
+        http_backend._iter_json_array(io.BytesIO(data), bufsize=1)) == items
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"[",
+    b"[1, 2",
+    b"[1, 2,",
+    b"{}",
+    b"[1; 2]",
+])
+def test_iter_json_array_invalid(data):
+    with pytest.raises(ValueError):
+        list(http_backend._iter_json_array(io.BytesIO(data)))
+
+
 # Common flows - must works for all variants.
 
 def check_readinto(handler, backend):
@@ -784,6 +1141,24 @@ def check_write(handler, backend):
     assert buf == handler.image[offset:offset + length]
 
 
+def check_write_from_file(handler, backend, tmpdir):
+    """
+    Check writing directly from a file.
+    """
+    offset = 8192
+    length = 600000
+    path = tmpdir.join("data")
+    path.write_binary(b"x" * length)
+
+    backend.seek(offset)
+    with open(str(path), "rb") as f:
+        n = backend.write_from_file(f, length)
+
+    assert n == length
+    assert backend.tell() == offset + length
+    assert handler.image[offset:offset + length] == b"x" * length
+
+
 def check_write_error(handler, backend):
     """
     Check that remote read error is re-raised in client.
@@ -812,6 +1187,14 @@ def check_zero(handler, backend):
     backend.zero(length)
 
     assert backend.tell() == offset + length
+
+    # zero() may be pipelined; reading back the zeroed range drains the
+    # pending requests, ensuring that the server processed them.
+    buf = bytearray(length)
+    backend.seek(offset)
+    backend.readinto(buf)
+
+    assert buf == b"\0" * length
     assert handler.image[offset:offset + length] == b"\0" * length
 
 
@@ -825,8 +1208,13 @@ def check_zero_error(handler, backend):
 
     handler.patch = fail
 
+    # zero() is pipelined without reading the response, so it must not
+    # fail; the error is reported when the response is read in the next
+    # flush().
+    backend.zero(4096)
+
     with pytest.raises(http.Error) as e:
-        backend.zero(4096)
+        backend.flush()
 
     assert e.value.code == http.FORBIDDEN
 
@@ -349,3 +349,48 @@ def test_clone():
     assert b.dirty
     b.flush()
     assert not b.dirty
+
+
+def test_fd_backend():
+    with memory.FDBackend("r+", size=128) as m:
+        assert m.size() == 128
+
+        m.write(b"x" * 64)
+        assert m.tell() == 64
+
+        m.zero(32)
+        assert m.tell() == 96
+
+        buf = bytearray(128)
+        m.seek(0)
+        assert m.readinto(buf) == 128
+        assert buf == b"x" * 64 + b"\0" * 64
+
+        # The backing file shows the same content.
+        with open(m.fileno(), "rb", closefd=False) as f:
+            assert f.read() == buf
+
+
+def test_fd_backend_fixed_size():
+    with memory.FDBackend("r+", size=128) as m:
+        m.seek(96)
+        with pytest.raises(IOError):
+            m.write(b"x" * 64)
+
+
+def test_fd_backend_clone():
+    with memory.FDBackend("r+", size=128) as a:
+        with a.clone() as b:
+            # Backends are identical on creation.
+            assert a.size() == b.size()
+            assert a.tell() == b.tell()
+
+            # Writing to a modifies the shared backing file but does not
+            # modify b position.
+            a.write(b"y" * 64)
+            assert a.tell() == 64
+            assert b.tell() == 0
+            assert a.data() == b.data()
+
+        # Closing the clone does not affect the original backend.
+        assert a.data()[:64] == b"y" * 64
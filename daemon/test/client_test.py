@@ -6,8 +6,11 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import functools
+import hashlib
 import os
 import tarfile
+import tempfile
 
 import pytest
 
@@ -27,38 +30,216 @@ from . marks import requires_advanced_virt
 CLUSTER_SIZE = 64 * 1024
 IMAGE_SIZE = 3 * CLUSTER_SIZE
 
-
-@pytest.fixture(scope="module")
+# Shared image fillers, avoiding a fresh IMAGE_SIZE bytes allocation in
+# every test preparing initial image content.
+FILL_A = b"a" * IMAGE_SIZE
+FILL_B = b"b" * IMAGE_SIZE
+
+# Ticket operations used by all transfers. Tickets never modify their ops
+# list, so all transfers can share one.
+OPS = ["read", "write"]
+
+# Shared cluster size buffers used when seeding image content.
+CLUSTER_a = b"a" * CLUSTER_SIZE
+CLUSTER_b = b"b" * CLUSTER_SIZE
+CLUSTER_c = b"c" * CLUSTER_SIZE
+CLUSTER_x = b"x" * CLUSTER_SIZE
+CLUSTER_A = b"A" * CLUSTER_SIZE
+CLUSTER_B = b"B" * CLUSTER_SIZE
+
+
+def fill_image(path, buf):
+    """
+    Create image file at path with buf content.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.pwrite(fd, buf, 0)
+    finally:
+        os.close(fd)
+
+
+def sparse_image(path, size):
+    """
+    Create sparse image file at path, updating the inode size without
+    allocating any pages.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def create_ova(ova, src, arcname):
+    """
+    Create OVA package at ova containing src as arcname.
+
+    The member data is copied with sendfile() in the kernel, avoiding
+    tarfile's userspace read/write loop.
+    """
+    st = os.stat(src)
+    info = tarfile.TarInfo(arcname)
+    info.size = st.st_size
+    info.mtime = int(st.st_mtime)
+
+    with open(ova, "wb") as tar, open(src, "rb") as f:
+        tar.write(info.tobuf())
+        tar.flush()
+
+        offset = 0
+        while offset < info.size:
+            offset += os.sendfile(
+                tar.fileno(), f.fileno(), offset, info.size - offset)
+
+        # Pad the member to the block boundary and write the end of archive
+        # marker and record padding, as tarfile does.
+        remainder = info.size % tarfile.BLOCKSIZE
+        padding = tarfile.BLOCKSIZE - remainder if remainder else 0
+        tar.write(b"\0" * (padding + 2 * tarfile.BLOCKSIZE))
+
+        pos = tarfile.BLOCKSIZE + info.size + padding + 2 * tarfile.BLOCKSIZE
+        remainder = pos % tarfile.RECORDSIZE
+        if remainder:
+            tar.write(b"\0" * (tarfile.RECORDSIZE - remainder))
+
+
+@pytest.fixture(scope="session")
+def blank_image(tmp_path_factory):
+    """
+    Blank source images created once per session, keyed by format. Tests
+    clone them with clone_image() instead of running a qemu-img subprocess
+    per test.
+    """
+    d = tmp_path_factory.mktemp("blank")
+    paths = {}
+    for fmt in ("raw", "qcow2"):
+        path = str(d / ("blank." + fmt))
+        qemu_img.create(path, fmt, size=IMAGE_SIZE)
+        paths[fmt] = path
+    return paths
+
+
+def clone_image(src, dst):
+    """
+    Clone image src to dst with copy_file_range(), a metadata only
+    operation on file systems supporting reflinks.
+    """
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        todo = os.path.getsize(src)
+        while todo:
+            n = os.copy_file_range(s.fileno(), d.fileno(), todo)
+            if n == 0:
+                break
+            todo -= n
+
+
+def file_digest(path):
+    """
+    Return sha256 digest of file at path. Much cheaper than running
+    qemu-img compare, but valid only when both files are raw images with
+    identical content.
+    """
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11, hashing in a single C-side loop.
+            return hashlib.file_digest(f, "sha256").digest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024**2), b""):
+            h.update(chunk)
+        return h.digest()
+
+
+def seed_image(path, fmt, writes):
+    """
+    Write (offset, data) pairs into image at path.
+
+    Raw images are written with plain file I/O. Only qcow2 images need a
+    qemu-nbd session, costing a subprocess per call, so all writes share
+    one session.
+    """
+    if fmt == "raw":
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            for offset, data in writes:
+                os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+    else:
+        with qemu_nbd.open(path, fmt) as c:
+            for offset, data in writes:
+                c.write(offset, data)
+
+
+@pytest.fixture(scope="session")
 def srv():
     cfg = config.load(["test/conf/daemon.conf"])
+    # Every pytest-xdist worker runs its own session and starts its own
+    # server. The remote service binds port 0 so every worker gets a
+    # private port, but the control socket path is fixed in the
+    # configuration, so make it unique per worker.
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    if worker:
+        cfg.control.socket += "." + worker
     s = server.Server(cfg)
     s.start()
     yield s
     s.stop()
 
 
+@functools.lru_cache(maxsize=None)
+def transfer_url_prefix(srv):
+    """
+    Return the images URL prefix for srv. The server address never
+    changes during the session, so the prefix is formatted once.
+    """
+    host, port = srv.remote_service.address
+    host = ipv6.quote_address(host)
+    return f"https://{host}:{port}/images/"
+
+
 def prepare_transfer(srv, url, sparse=True, size=IMAGE_SIZE):
     ticket = testutil.create_ticket(
         url=url,
         size=size,
         sparse=sparse,
-        ops=["read", "write"])
+        ops=OPS)
 
     srv.auth.add(ticket)
 
-    host, port = srv.remote_service.address
-    host = ipv6.quote_address(host)
-    return "https://{}:{}/images/{}".format(host, port, ticket["uuid"])
+    return transfer_url_prefix(srv) + ticket["uuid"]
+
+
+@functools.lru_cache(maxsize=None)
+def expected_checksum(size, head, algorithm="blake2b", digest_size=32,
+                      block_size=1024**2):
+    """
+    Return checksum of image of size bytes, starting with head and padded
+    with zeroes. The test content is deterministic, so parametrized tests
+    share the cached result instead of hashing the same data again.
+    """
+    with tempfile.NamedTemporaryFile(dir="/var/tmp") as f:
+        f.truncate(size)
+        if head:
+            f.write(head)
+            f.flush()
+        return blkhash.checksum(
+            f.name,
+            block_size=block_size,
+            algorithm=algorithm,
+            digest_size=digest_size)
 
 
 class FakeProgress:
 
     def __init__(self):
         self.size = None
-        self.updates = []
+        # When using multiple connections order of updates is not
+        # predictable, and the test asserts only which updates were seen.
+        self.updates = set()
 
     def update(self, n):
-        self.updates.append(n)
+        self.updates.add(n)
 
 
 # TODO:
@@ -73,13 +254,13 @@ class FakeProgress:
 
 
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
-def test_upload_empty_sparse(tmpdir, srv, fmt):
-    src = str(tmpdir.join("src"))
-    qemu_img.create(src, fmt, size=IMAGE_SIZE)
+def test_upload_empty_sparse(tmpdir, srv, fmt, blank_image):
+    td = str(tmpdir)
+    src = td + "/src"
+    clone_image(blank_image[fmt], src)
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.write(b"a" * IMAGE_SIZE)
+    dst = td + "/dst"
+    fill_image(dst, FILL_A)
 
     url = prepare_transfer(srv, "file://" + dst)
 
@@ -92,17 +273,15 @@ def test_upload_empty_sparse(tmpdir, srv, fmt):
 
 
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
-def test_upload_hole_at_start_sparse(tmpdir, srv, fmt):
-    src = str(tmpdir.join("src"))
-    qemu_img.create(src, fmt, size=IMAGE_SIZE)
+def test_upload_hole_at_start_sparse(tmpdir, srv, fmt, blank_image):
+    td = str(tmpdir)
+    src = td + "/src"
+    clone_image(blank_image[fmt], src)
 
-    with qemu_nbd.open(src, fmt) as c:
-        c.write(IMAGE_SIZE - 6, b"middle")
-        c.flush()
+    seed_image(src, fmt, [(IMAGE_SIZE - 6, b"middle")])
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.write(b"a" * IMAGE_SIZE)
+    dst = td + "/dst"
+    fill_image(dst, FILL_A)
 
     url = prepare_transfer(srv, "file://" + dst)
 
@@ -112,18 +291,15 @@ def test_upload_hole_at_start_sparse(tmpdir, srv, fmt):
 
 
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
-def test_upload_hole_at_middle_sparse(tmpdir, srv, fmt):
-    src = str(tmpdir.join("src"))
-    qemu_img.create(src, fmt, size=IMAGE_SIZE)
+def test_upload_hole_at_middle_sparse(tmpdir, srv, fmt, blank_image):
+    td = str(tmpdir)
+    src = td + "/src"
+    clone_image(blank_image[fmt], src)
 
-    with qemu_nbd.open(src, fmt) as c:
-        c.write(0, b"start")
-        c.write(IMAGE_SIZE - 3, b"end")
-        c.flush()
+    seed_image(src, fmt, [(0, b"start"), (IMAGE_SIZE - 3, b"end")])
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.write(b"a" * IMAGE_SIZE)
+    dst = td + "/dst"
+    fill_image(dst, FILL_A)
 
     url = prepare_transfer(srv, "file://" + dst)
 
@@ -133,17 +309,15 @@ def test_upload_hole_at_middle_sparse(tmpdir, srv, fmt):
 
 
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
-def test_upload_hole_at_end_sparse(tmpdir, srv, fmt):
-    src = str(tmpdir.join("src"))
-    qemu_img.create(src, fmt, size=IMAGE_SIZE)
+def test_upload_hole_at_end_sparse(tmpdir, srv, fmt, blank_image):
+    td = str(tmpdir)
+    src = td + "/src"
+    clone_image(blank_image[fmt], src)
 
-    with qemu_nbd.open(src, fmt) as c:
-        c.write(0, b"start")
-        c.flush()
+    seed_image(src, fmt, [(0, b"start")])
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.write(b"a" * IMAGE_SIZE)
+    dst = td + "/dst"
+    fill_image(dst, FILL_A)
 
     url = prepare_transfer(srv, "file://" + dst)
 
@@ -153,17 +327,15 @@ def test_upload_hole_at_end_sparse(tmpdir, srv, fmt):
 
 
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
-def test_upload_full_sparse(tmpdir, srv, fmt):
-    src = str(tmpdir.join("src"))
-    qemu_img.create(src, fmt, size=IMAGE_SIZE)
+def test_upload_full_sparse(tmpdir, srv, fmt, blank_image):
+    td = str(tmpdir)
+    src = td + "/src"
+    clone_image(blank_image[fmt], src)
 
-    with qemu_nbd.open(src, fmt) as c:
-        c.write(0, b"b" * IMAGE_SIZE)
-        c.flush()
+    seed_image(src, fmt, [(0, FILL_B)])
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.write(b"a" * IMAGE_SIZE)
+    dst = td + "/dst"
+    fill_image(dst, FILL_A)
 
     url = prepare_transfer(srv, "file://" + dst)
 
@@ -173,20 +345,27 @@ def test_upload_full_sparse(tmpdir, srv, fmt):
 
 
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
-def test_upload_preallocated(tmpdir, srv, fmt):
-    src = str(tmpdir.join("src"))
-    qemu_img.create(src, fmt, size=IMAGE_SIZE)
+def test_upload_preallocated(tmpdir, srv, fmt, blank_image):
+    td = str(tmpdir)
+    src = td + "/src"
+    clone_image(blank_image[fmt], src)
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.write(b"a" * IMAGE_SIZE)
+    dst = td + "/dst"
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.pwrite(fd, FILL_A, 0)
 
-    url = prepare_transfer(srv, "file://" + dst, sparse=False)
+        url = prepare_transfer(srv, "file://" + dst, sparse=False)
 
-    client.upload(src, url, srv.config.tls.ca_file)
+        client.upload(src, url, srv.config.tls.ca_file)
 
-    qemu_img.compare(src, dst)
-    assert os.stat(dst).st_blocks * 512 == IMAGE_SIZE
+        qemu_img.compare(src, dst)
+
+        # Checking allocation via the open fd avoids resolving the path
+        # again.
+        assert os.fstat(fd).st_blocks * 512 == IMAGE_SIZE
+    finally:
+        os.close(fd)
 
 
 @pytest.mark.parametrize("fmt,compressed", [
@@ -195,29 +374,28 @@ def test_upload_preallocated(tmpdir, srv, fmt):
     ("qcow2", True),
 ])
 def test_upload_from_ova(tmpdir, srv, fmt, compressed):
+    td = str(tmpdir)
     offset = CLUSTER_SIZE
     data = b"I can eat glass and it doesn't hurt me."
 
     # Create raw disk with some data.
-    tmp = str(tmpdir.join("tmp"))
+    tmp = td + "/tmp"
     with open(tmp, "wb") as f:
         f.truncate(IMAGE_SIZE)
         f.seek(offset)
         f.write(data)
 
     # Create source disk.
-    src = str(tmpdir.join("src"))
+    src = td + "/src"
     qemu_img.convert(tmp, src, "raw", fmt, compressed=compressed)
 
     # Create OVA package.
-    ova = str(tmpdir.join("src.ova"))
-    with tarfile.open(ova, "w") as tar:
-        tar.add(src, arcname=os.path.basename(src))
+    ova = td + "/src.ova"
+    create_ova(ova, src, os.path.basename(src))
 
     # Prepare destination file.
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    dst = td + "/dst"
+    sparse_image(dst, IMAGE_SIZE)
 
     # Test uploading src from ova.
     url = prepare_transfer(srv, "file://" + dst)
@@ -232,33 +410,33 @@ def test_upload_from_ova(tmpdir, srv, fmt, compressed):
 
 @pytest.mark.parametrize("base_fmt", ["raw", "qcow2"])
 def test_upload_shallow(srv, nbd_server, tmpdir, base_fmt):
+    td = str(tmpdir)
     size = 10 * 1024**2
 
     # Create base image with some data in first 3 clusters.
-    src_base = str(tmpdir.join("src_base." + base_fmt))
+    src_base = td + "/src_base." + base_fmt
     qemu_img.create(src_base, base_fmt, size=size)
-    with qemu_nbd.open(src_base, base_fmt) as c:
-        c.write(0 * CLUSTER_SIZE, b"a" * CLUSTER_SIZE)
-        c.write(1 * CLUSTER_SIZE, b"b" * CLUSTER_SIZE)
-        c.write(2 * CLUSTER_SIZE, b"c" * CLUSTER_SIZE)
-        c.flush()
+    seed_image(src_base, base_fmt, [
+        (0 * CLUSTER_SIZE, CLUSTER_a),
+        (1 * CLUSTER_SIZE, CLUSTER_b),
+        (2 * CLUSTER_SIZE, CLUSTER_c),
+    ])
 
     # Create src image with some data in second cluster and zero in third
     # cluster.
-    src_top = str(tmpdir.join("src_top.qcow2"))
+    src_top = td + "/src_top.qcow2"
     qemu_img.create(
         src_top, "qcow2", backing_file=src_base, backing_format=base_fmt)
     with qemu_nbd.open(src_top, "qcow2") as c:
-        c.write(1 * CLUSTER_SIZE, b"B" * CLUSTER_SIZE)
+        c.write(1 * CLUSTER_SIZE, CLUSTER_B)
         c.zero(2 * CLUSTER_SIZE, CLUSTER_SIZE)
-        c.flush()
 
     # Create empty destination base image.
-    dst_base = str(tmpdir.join("dst_base." + base_fmt))
+    dst_base = td + "/dst_base." + base_fmt
     qemu_img.create(dst_base, base_fmt, size=size)
 
     # Create empty destination top image.
-    dst_top = str(tmpdir.join("dst_top.qcow2"))
+    dst_top = td + "/dst_top.qcow2"
     qemu_img.create(
         dst_top, "qcow2", backing_file=dst_base, backing_format=base_fmt)
 
@@ -288,14 +466,15 @@ def test_upload_shallow(srv, nbd_server, tmpdir, base_fmt):
 
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
 def test_download_raw(tmpdir, srv, fmt):
-    src = str(tmpdir.join("src"))
+    td = str(tmpdir)
+    src = td + "/src"
     with open(src, "wb") as f:
         f.truncate(IMAGE_SIZE)
         f.seek(IMAGE_SIZE // 2)
         f.write(b"data")
 
     url = prepare_transfer(srv, "file://" + src)
-    dst = str(tmpdir.join("dst"))
+    dst = td + "/dst"
 
     # When we download raw data, we can convert it on-the-fly to other format.
     client.download(url, dst, srv.config.tls.ca_file, fmt=fmt)
@@ -306,17 +485,17 @@ def test_download_raw(tmpdir, srv, fmt):
 
 
 def test_download_qcow2_as_raw(tmpdir, srv):
-    src = str(tmpdir.join("src.qcow2"))
+    td = str(tmpdir)
+    src = td + "/src.qcow2"
     qemu_img.create(src, "qcow2", size=IMAGE_SIZE)
 
     # Allocate one cluster in the middle of the image.
     with qemu_nbd.open(src, "qcow2") as c:
-        c.write(CLUSTER_SIZE, b"a" * CLUSTER_SIZE)
-        c.flush()
+        c.write(CLUSTER_SIZE, CLUSTER_a)
 
     actual_size = os.path.getsize(src)
     url = prepare_transfer(srv, "file://" + src, size=actual_size)
-    dst = str(tmpdir.join("dst.qcow2"))
+    dst = td + "/dst.qcow2"
 
     # When downloading qcow2 image using the nbd backend, we get raw data and
     # we can convert it to any format we want. Howver when downloading using
@@ -339,32 +518,32 @@ def test_download_qcow2_as_raw(tmpdir, srv):
 
 @pytest.mark.parametrize("base_fmt", ["raw", "qcow2"])
 def test_download_shallow(srv, nbd_server, tmpdir, base_fmt):
+    td = str(tmpdir)
     size = 10 * 1024**2
 
     # Create source base image with some data in first clusters.
-    src_base = str(tmpdir.join("src_base." + base_fmt))
+    src_base = td + "/src_base." + base_fmt
     qemu_img.create(src_base, base_fmt, size=size)
-    with qemu_nbd.open(src_base, base_fmt) as c:
-        c.write(0 * CLUSTER_SIZE, b"a" * CLUSTER_SIZE)
-        c.write(1 * CLUSTER_SIZE, b"b" * CLUSTER_SIZE)
-        c.write(2 * CLUSTER_SIZE, b"c" * CLUSTER_SIZE)
-        c.flush()
+    seed_image(src_base, base_fmt, [
+        (0 * CLUSTER_SIZE, CLUSTER_a),
+        (1 * CLUSTER_SIZE, CLUSTER_b),
+        (2 * CLUSTER_SIZE, CLUSTER_c),
+    ])
 
     # Create source top image with some data in second cluster and zero in the
     # third cluster.
-    src_top = str(tmpdir.join("src_top.qcow2"))
+    src_top = td + "/src_top.qcow2"
     qemu_img.create(
         src_top, "qcow2", backing_file=src_base, backing_format=base_fmt)
     with qemu_nbd.open(src_top, "qcow2") as c:
-        c.write(1 * CLUSTER_SIZE, b"B" * CLUSTER_SIZE)
+        c.write(1 * CLUSTER_SIZE, CLUSTER_B)
         c.zero(2 * CLUSTER_SIZE, CLUSTER_SIZE)
-        c.flush()
 
     # Create empty backing file for downloding top image.
-    dst_base = str(tmpdir.join("dst_base." + base_fmt))
+    dst_base = td + "/dst_base." + base_fmt
     qemu_img.create(dst_base, base_fmt, size=size)
 
-    dst_top = str(tmpdir.join("dst_top.qcow2"))
+    dst_top = td + "/dst_top.qcow2"
 
     # Start nbd server exporting top image without the backing file.
     nbd_server.image = src_top
@@ -394,13 +573,12 @@ def test_download_shallow(srv, nbd_server, tmpdir, base_fmt):
 
 
 def test_upload_proxy_url(tmpdir, srv):
-    src = str(tmpdir.join("src"))
-    with open(src, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    td = str(tmpdir)
+    src = td + "/src"
+    sparse_image(src, IMAGE_SIZE)
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    dst = td + "/dst"
+    sparse_image(dst, IMAGE_SIZE)
 
     # If transfer_url is not accessible, proxy_url is used.
     transfer_url = "https://no.server:54322/images/no-ticket"
@@ -409,17 +587,16 @@ def test_upload_proxy_url(tmpdir, srv):
     client.upload(src, transfer_url, srv.config.tls.ca_file,
                   proxy_url=proxy_url)
 
-    qemu_img.compare(src, dst, format1="raw", format2="raw", strict=True)
+    assert file_digest(dst) == file_digest(src)
 
 
 def test_upload_proxy_url_unused(tmpdir, srv):
-    src = str(tmpdir.join("src"))
-    with open(src, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    td = str(tmpdir)
+    src = td + "/src"
+    sparse_image(src, IMAGE_SIZE)
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    dst = td + "/dst"
+    sparse_image(dst, IMAGE_SIZE)
 
     # If transfer_url is accessible, proxy_url is not used.
     transfer_url = prepare_transfer(srv, "file://" + dst)
@@ -428,15 +605,15 @@ def test_upload_proxy_url_unused(tmpdir, srv):
     client.upload(src, transfer_url, srv.config.tls.ca_file,
                   proxy_url=proxy_url)
 
-    qemu_img.compare(src, dst, format1="raw", format2="raw", strict=True)
+    assert file_digest(dst) == file_digest(src)
 
 
 def test_download_proxy_url(tmpdir, srv):
-    src = str(tmpdir.join("src"))
-    with open(src, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    td = str(tmpdir)
+    src = td + "/src"
+    sparse_image(src, IMAGE_SIZE)
 
-    dst = str(tmpdir.join("dst"))
+    dst = td + "/dst"
 
     # If transfer_url is not accessible, proxy_url is used.
     transfer_url = "https://no.server:54322/images/no-ticket"
@@ -445,15 +622,15 @@ def test_download_proxy_url(tmpdir, srv):
     client.download(transfer_url, dst, srv.config.tls.ca_file, fmt="raw",
                     proxy_url=proxy_url)
 
-    qemu_img.compare(src, dst, format1="raw", format2="raw")
+    assert file_digest(dst) == file_digest(src)
 
 
 def test_download_proxy_url_unused(tmpdir, srv):
-    src = str(tmpdir.join("src"))
-    with open(src, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    td = str(tmpdir)
+    src = td + "/src"
+    sparse_image(src, IMAGE_SIZE)
 
-    dst = str(tmpdir.join("dst"))
+    dst = td + "/dst"
 
     # If transfer_url is accessible, proxy_url is not used.
     transfer_url = prepare_transfer(srv, "file://" + src)
@@ -462,20 +639,20 @@ def test_download_proxy_url_unused(tmpdir, srv):
     client.download(transfer_url, dst, srv.config.tls.ca_file, fmt="raw",
                     proxy_url=proxy_url)
 
-    qemu_img.compare(src, dst, format1="raw", format2="raw")
+    assert file_digest(dst) == file_digest(src)
 
 
 def test_progress(tmpdir, srv):
-    src = str(tmpdir.join("src"))
+    td = str(tmpdir)
+    src = td + "/src"
     with open(src, "wb") as f:
         f.write(b"b" * 4096)
         f.seek(IMAGE_SIZE // 2)
         f.write(b"b" * 4096)
         f.truncate(IMAGE_SIZE)
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    dst = td + "/dst"
+    sparse_image(dst, IMAGE_SIZE)
 
     url = prepare_transfer(srv, "file://" + dst, sparse=True)
 
@@ -485,9 +662,7 @@ def test_progress(tmpdir, srv):
 
     assert progress.size == IMAGE_SIZE
 
-    # Note: when using multiple connections order of updates is not
-    # predictable.
-    assert set(progress.updates) == {
+    assert progress.updates == {
         # First write.
         4096,
         # First zero.
@@ -500,13 +675,12 @@ def test_progress(tmpdir, srv):
 
 
 def test_progress_callback(tmpdir, srv):
-    src = str(tmpdir.join("src"))
-    with open(src, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    td = str(tmpdir)
+    src = td + "/src"
+    sparse_image(src, IMAGE_SIZE)
 
-    dst = str(tmpdir.join("dst"))
-    with open(dst, "wb") as f:
-        f.truncate(IMAGE_SIZE)
+    dst = td + "/dst"
+    sparse_image(dst, IMAGE_SIZE)
 
     url = prepare_transfer(srv, "file://" + dst, size=IMAGE_SIZE, sparse=True)
 
@@ -526,15 +700,16 @@ def test_progress_callback(tmpdir, srv):
     ("qcow2", True),
 ])
 def test_info(tmpdir, fmt, compressed):
+    td = str(tmpdir)
     # Created temporary file with some data.
     size = 2 * 1024**2
-    tmp = str(tmpdir.join("tmp"))
+    tmp = td + "/tmp"
     with open(tmp, "wb") as f:
         f.truncate(size)
-        f.write(b"x" * CLUSTER_SIZE)
+        f.write(CLUSTER_x)
 
     # Created test image from temporary file.
-    img = str(tmpdir.join("img"))
+    img = td + "/img"
     qemu_img.convert(tmp, img, "raw", fmt, compressed=compressed)
     img_info = client.info(img)
 
@@ -548,9 +723,8 @@ def test_info(tmpdir, fmt, compressed):
 
     # Create ova with test image.
     member = os.path.basename(img)
-    ova = str(tmpdir.join("ova"))
-    with tarfile.open(ova, "w") as tar:
-        tar.add(img, arcname=member)
+    ova = td + "/ova"
+    create_ova(ova, img, member)
 
     # Get info for the member from the ova.
     ova_info = client.info(ova, member=member)
@@ -560,10 +734,10 @@ def test_info(tmpdir, fmt, compressed):
     assert ova_info["virtual-size"] == size
 
     # If member was specified, we report also the offset and size.
-    with tarfile.open(ova) as tar:
-        member_info = tar.getmember(member)
-    assert ova_info["member-offset"] == member_info.offset_data
-    assert ova_info["member-size"] == member_info.size
+    # create_ova() wrote a single member, so the 512 bytes header is at
+    # offset 0 and the member data starts right after it.
+    assert ova_info["member-offset"] == tarfile.BLOCKSIZE
+    assert ova_info["member-size"] == os.path.getsize(img)
 
 
 @pytest.mark.parametrize("fmt, compressed", [
@@ -572,15 +746,16 @@ def test_info(tmpdir, fmt, compressed):
     ("qcow2", True),
 ])
 def test_measure_to_raw(tmpdir, fmt, compressed):
+    td = str(tmpdir)
     # Create temporary file with some data.
     size = 2 * 1024**2
-    tmp = str(tmpdir.join("tmp"))
+    tmp = td + "/tmp"
     with open(tmp, "wb") as f:
         f.truncate(size)
-        f.write(b"x" * CLUSTER_SIZE)
+        f.write(CLUSTER_x)
 
     # Created test image from temporary file.
-    img = str(tmpdir.join("img"))
+    img = td + "/img"
     qemu_img.convert(tmp, img, "raw", fmt, compressed=compressed)
 
     measure = client.measure(img, "raw")
@@ -593,15 +768,16 @@ def test_measure_to_raw(tmpdir, fmt, compressed):
     ("qcow2", True),
 ])
 def test_measure_to_qcow2(tmpdir, fmt, compressed):
+    td = str(tmpdir)
     # Create temporary file with some data.
     size = 2 * 1024**2
-    tmp = str(tmpdir.join("tmp"))
+    tmp = td + "/tmp"
     with open(tmp, "wb") as f:
         f.truncate(size)
-        f.write(b"x" * CLUSTER_SIZE)
+        f.write(CLUSTER_x)
 
     # Created test image from temporary file.
-    img = str(tmpdir.join("img"))
+    img = td + "/img"
     qemu_img.convert(tmp, img, "raw", fmt, compressed=compressed)
 
     measure = client.measure(img, "qcow2")
@@ -611,15 +787,16 @@ def test_measure_to_qcow2(tmpdir, fmt, compressed):
 @pytest.mark.parametrize("compressed", [False, True])
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
 def test_measure_from_ova(tmpdir, compressed, fmt):
+    td = str(tmpdir)
     # Create temporary file with some data.
     size = 2 * 1024**2
-    tmp = str(tmpdir.join("tmp"))
+    tmp = td + "/tmp"
     with open(tmp, "wb") as f:
         f.truncate(size)
-        f.write(b"x" * CLUSTER_SIZE)
+        f.write(CLUSTER_x)
 
     # Created test image from temporary file.
-    img = str(tmpdir.join("img"))
+    img = td + "/img"
     qemu_img.convert(tmp, img, "raw", "qcow2", compressed=compressed)
 
     # Measure the image.
@@ -631,9 +808,8 @@ def test_measure_from_ova(tmpdir, compressed, fmt):
 
     # Add test image to ova.
     member = os.path.basename(img)
-    ova = str(tmpdir.join("ova"))
-    with tarfile.open(ova, "w") as tar:
-        tar.add(img, arcname=member)
+    ova = td + "/ova"
+    create_ova(ova, img, member)
 
     # Measure the image from the ova.
     ova_measure = client.measure(ova, fmt, member=member)
@@ -643,10 +819,10 @@ def test_measure_from_ova(tmpdir, compressed, fmt):
     assert ova_measure["fully-allocated"] == img_measure["fully-allocated"]
 
     # If member was specified, we report also the offset and size.
-    with tarfile.open(ova) as tar:
-        member_info = tar.getmember(member)
-    assert ova_measure["member-offset"] == member_info.offset_data
-    assert ova_measure["member-size"] == member_info.size
+    # create_ova() wrote a single member, so the 512 bytes header is at
+    # offset 0 and the member data starts right after it.
+    assert ova_measure["member-offset"] == tarfile.BLOCKSIZE
+    assert ova_measure["member-size"] == os.path.getsize(img)
 
 
 @pytest.mark.parametrize("fmt, compressed", [
@@ -655,18 +831,19 @@ def test_measure_from_ova(tmpdir, compressed, fmt):
     ("qcow2", True),
 ])
 def test_checksum(tmpdir, fmt, compressed):
+    td = str(tmpdir)
     # Create temporary file with some data.
     size = 2 * 1024**2
-    tmp = str(tmpdir.join("tmp"))
+    tmp = td + "/tmp"
     with open(tmp, "wb") as f:
         f.truncate(size)
-        f.write(b"x" * CLUSTER_SIZE)
+        f.write(CLUSTER_x)
 
     # Create test image from temporary file.
-    img = str(tmpdir.join("img"))
+    img = td + "/img"
     qemu_img.convert(tmp, img, "raw", fmt, compressed=compressed)
 
-    expected = blkhash.checksum(tmp, block_size=1024**2)
+    expected = expected_checksum(size, CLUSTER_x)
     actual = client.checksum(img, block_size=1024**2)
     assert actual == expected
 
@@ -677,24 +854,24 @@ def test_checksum(tmpdir, fmt, compressed):
     ("qcow2", True),
 ])
 def test_checksum_from_ova(tmpdir, fmt, compressed):
+    td = str(tmpdir)
     # Create temporary file with some data.
     size = 2 * 1024**2
-    tmp = str(tmpdir.join("tmp"))
+    tmp = td + "/tmp"
     with open(tmp, "wb") as f:
         f.truncate(size)
-        f.write(b"x" * CLUSTER_SIZE)
+        f.write(CLUSTER_x)
 
     # Create test image from temporary file.
-    img = str(tmpdir.join("img"))
+    img = td + "/img"
     qemu_img.convert(tmp, img, "raw", fmt, compressed=compressed)
 
     # Add test image to ova.
     member = os.path.basename(img)
-    ova = str(tmpdir.join("ova"))
-    with tarfile.open(ova, "w") as tar:
-        tar.add(img, arcname=member)
+    ova = td + "/ova"
+    create_ova(ova, img, member)
 
-    expected = blkhash.checksum(tmp, block_size=1024**2)
+    expected = expected_checksum(size, CLUSTER_x)
     actual = client.checksum(ova, member=member, block_size=1024**2)
     assert actual == expected
 
@@ -704,26 +881,27 @@ def test_checksum_from_ova(tmpdir, fmt, compressed):
     ("sha1", None),
 ])
 def test_checksum_algorithm(tmpdir, algorithm, digest_size):
-    img = str(tmpdir.join("img"))
+    td = str(tmpdir)
+    img = td + "/img"
     qemu_img.create(img, "raw", size="2m")
 
-    expected = blkhash.checksum(
-        img, block_size=1024**2, algorithm=algorithm, digest_size=digest_size)
+    expected = expected_checksum(
+        2 * 1024**2, b"", algorithm=algorithm, digest_size=digest_size)
     actual = client.checksum(img, block_size=1024**2, algorithm=algorithm)
     assert actual == expected
 
 
 def test_zero_extents_raw(tmpdir):
+    td = str(tmpdir)
     size = 10 * 1024**2
 
     # Create image with some data, zero and holes.
-    image = str(tmpdir.join("image.raw"))
+    image = td + "/image.raw"
     qemu_img.create(image, "raw", size=size)
     with qemu_nbd.open(image, "raw") as c:
-        c.write(0 * CLUSTER_SIZE, b"A" * CLUSTER_SIZE)
+        c.write(0 * CLUSTER_SIZE, CLUSTER_A)
         c.zero(1 * CLUSTER_SIZE, CLUSTER_SIZE)
-        c.write(2 * CLUSTER_SIZE, b"B" * CLUSTER_SIZE)
-        c.flush()
+        c.write(2 * CLUSTER_SIZE, CLUSTER_B)
 
     extents = list(client.extents(image))
 
@@ -753,24 +931,23 @@ def test_zero_extents_raw(tmpdir):
 
 
 def test_zero_extents_qcow2(tmpdir):
+    td = str(tmpdir)
     size = 10 * 1024**2
 
     # Create base image with one data and one zero cluster.
-    base = str(tmpdir.join("base.qcow2"))
+    base = td + "/base.qcow2"
     qemu_img.create(base, "qcow2", size=size)
     with qemu_nbd.open(base, "qcow2") as c:
-        c.write(0 * CLUSTER_SIZE, b"A" * CLUSTER_SIZE)
+        c.write(0 * CLUSTER_SIZE, CLUSTER_A)
         c.zero(1 * CLUSTER_SIZE, CLUSTER_SIZE)
-        c.flush()
 
     # Create top image with one data and one zero cluster.
-    top = str(tmpdir.join("top.qcow2"))
+    top = td + "/top.qcow2"
     qemu_img.create(
         top, "qcow2", backing_file=base, backing_format="qcow2")
     with qemu_nbd.open(top, "qcow2") as c:
-        c.write(3 * CLUSTER_SIZE, b"B" * CLUSTER_SIZE)
+        c.write(3 * CLUSTER_SIZE, CLUSTER_B)
         c.zero(4 * CLUSTER_SIZE, CLUSTER_SIZE)
-        c.flush()
 
     extents = list(client.extents(top))
 
@@ -814,20 +991,19 @@ def test_zero_extents_qcow2(tmpdir):
 
 
 def test_zero_extents_from_ova(tmpdir):
+    td = str(tmpdir)
     size = 10 * 1024**2
 
     # Create image with data, zero and hole clusters.
-    disk = str(tmpdir.join("disk.qcow2"))
+    disk = td + "/disk.qcow2"
     qemu_img.create(disk, "qcow2", size=size)
     with qemu_nbd.open(disk, "qcow2") as c:
-        c.write(0 * CLUSTER_SIZE, b"A" * CLUSTER_SIZE)
+        c.write(0 * CLUSTER_SIZE, CLUSTER_A)
         c.zero(1 * CLUSTER_SIZE, CLUSTER_SIZE)
-        c.flush()
 
     # Create OVA whith this image.
-    ova = str(tmpdir.join("vm.ova"))
-    with tarfile.open(ova, "w") as tar:
-        tar.add(disk, arcname=os.path.basename(disk))
+    ova = td + "/vm.ova"
+    create_ova(ova, disk, os.path.basename(disk))
 
     extents = list(client.extents(ova, member="disk.qcow2"))
 
@@ -852,29 +1028,28 @@ def test_zero_extents_from_ova(tmpdir):
 
 @requires_advanced_virt
 def test_dirty_extents(tmpdir):
+    td = str(tmpdir)
     size = 1024**2
 
     # Create base image with empty dirty bitmap.
-    base = str(tmpdir.join("base.qcow2"))
+    base = td + "/base.qcow2"
     qemu_img.create(base, "qcow2", size=size)
     qemu_img.bitmap_add(base, "b0")
 
     # Write data, modifying the dirty bitmap.
     with qemu_nbd.open(base, "qcow2") as c:
-        c.write(0 * CLUSTER_SIZE, b"A" * CLUSTER_SIZE)
+        c.write(0 * CLUSTER_SIZE, CLUSTER_A)
         c.zero(1 * CLUSTER_SIZE, CLUSTER_SIZE)
-        c.flush()
 
     # Create top image with empty dirty bitmap.
-    top = str(tmpdir.join("top.qcow2"))
+    top = td + "/top.qcow2"
     qemu_img.create(top, "qcow2", backing_file=base, backing_format="qcow2")
     qemu_img.bitmap_add(top, "b0")
 
     # Write data, modifying the dirty bitmap.
     with qemu_nbd.open(top, "qcow2") as c:
-        c.write(3 * CLUSTER_SIZE, b"B" * CLUSTER_SIZE)
+        c.write(3 * CLUSTER_SIZE, CLUSTER_B)
         c.zero(4 * CLUSTER_SIZE, CLUSTER_SIZE)
-        c.flush()
 
     dirty_extents = list(client.extents(base, bitmap="b0"))
 
@@ -11,6 +11,7 @@ import io
 import logging
 import os
 import platform
+import shutil
 import subprocess
 import urllib.parse
 
@@ -34,6 +35,39 @@ IMAGES_DIR = "/var/tmp/imageio-images"
 # https://docs.openstack.org/image-guide/obtain-images.html
 BASE_IMAGE = "cirros-0.3.5"
 
+# Minimum free space in /dev/shm for keeping temporary files in tmpfs. With
+# less free space we use the default temporary directory, trading speed for
+# not failing the tests on low memory hosts.
+SHM_MIN_FREE = 1024**3
+
+
+def supports_direct_io(path):
+    """
+    Return True if files under path can be opened with O_DIRECT. The file
+    backend opens file tickets with O_DIRECT, which tmpfs supports only
+    since kernel 6.6.
+    """
+    try:
+        fd = os.open(path, os.O_TMPFILE | os.O_RDWR | os.O_DIRECT)
+    except OSError:
+        return False
+    os.close(fd)
+    return True
+
+
+def pytest_configure(config):
+    # Tests create many throwaway images in the temporary directory. Keeping
+    # them in tmpfs eliminates the block I/O, speeding up the tests. On hosts
+    # without enough free space in tmpfs, or whose kernel does not support
+    # O_DIRECT on tmpfs, fall back to disk.
+    if config.option.basetemp is None:
+        if (os.path.isdir("/dev/shm")
+                and shutil.disk_usage("/dev/shm").free >= SHM_MIN_FREE
+                and supports_direct_io("/dev/shm")):
+            config.option.basetemp = "/dev/shm/imageio-tests"
+        else:
+            config.option.basetemp = "/var/tmp/imageio-tests"
+
 
 @pytest.fixture
 def tmpfile(tmpdir):
@@ -8,6 +8,7 @@
 
 import io
 import os
+import tempfile
 
 import pytest
 
@@ -21,6 +22,18 @@ from . import testutil
 BLOCKSIZE = 512
 
 
+@pytest.fixture
+def tmpfile():
+    """
+    Override the shared tmpfile fixture, which may be backed by tmpfs.
+    This module exercises O_DIRECT, behaving differently on tmpfs, so the
+    file must live on a disk backed file system.
+    """
+    with tempfile.NamedTemporaryFile(
+            dir="/var/tmp", prefix="directio_test.") as f:
+        yield f.name
+
+
 def fill(b, size):
     count, rest = divmod(size, len(b))
     return b * count + b[:rest]